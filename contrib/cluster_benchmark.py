@@ -0,0 +1,109 @@
+"""
+Compare the recursive query in `compute_cluster` with the breadth-first search it
+replaced, which made one round trip per hop. Synthetic clusters are written into
+the link table inside a transaction which is rolled back at the end.
+
+    python contrib/cluster_benchmark.py --size 2000
+"""
+import sys
+import time
+import click
+from typing import Callable, List, Set, Tuple
+from sqlalchemy.sql import select, insert, or_
+
+from storyweb.db import Conn, engine, link_table
+from storyweb.logic.links import compute_cluster
+from storyweb.ontology import LinkType
+
+
+def compute_cluster_bfs(conn: Conn, id: str) -> Set[str]:
+    link_t = link_table.alias("l")
+    target = link_t.c.target
+    source = link_t.c.source
+    connected = set([id])
+    fresh = set([id])
+    while len(fresh):
+        stmt = select(target.label("target"), source.label("source"))
+        stmt = stmt.filter(link_t.c.type == LinkType.SAME)
+        stmt = stmt.filter(or_(source.in_(fresh), target.in_(fresh)))
+        fresh = set()
+        for row in conn.execute(stmt):
+            for node in (row.source, row.target):
+                if node not in connected:
+                    fresh.add(node)
+                    connected.add(node)
+    return connected
+
+
+def _node(name: str, i: int) -> str:
+    return f"bench-{name}-{i:08d}"
+
+
+def deep(size: int) -> List[Tuple[str, str]]:
+    """A chain, with the links pointing in alternating directions."""
+    edges = []
+    for i in range(size - 1):
+        a, b = _node("deep", i), _node("deep", i + 1)
+        edges.append((a, b) if i % 2 == 0 else (b, a))
+    return edges
+
+
+def wide(size: int) -> List[Tuple[str, str]]:
+    """A star of `size` tags, all linked to one hub, plus a ring around it."""
+    hub = _node("wide", 0)
+    edges = [(_node("wide", i), hub) for i in range(1, size)]
+    edges.extend((_node("wide", i), _node("wide", i + 1)) for i in range(1, size - 1))
+    return edges
+
+
+def tree(size: int, fanout: int = 4) -> List[Tuple[str, str]]:
+    return [(_node("tree", i), _node("tree", (i - 1) // fanout)) for i in range(1, size)]
+
+
+def _time(func: Callable[[Conn, str], Set[str]], conn: Conn, id: str, runs: int):
+    start = time.perf_counter()
+    for _ in range(runs):
+        result = func(conn, id)
+    return result, (time.perf_counter() - start) / runs
+
+
+@click.command()
+@click.option("--size", type=int, default=1000, help="Tags per cluster")
+@click.option("--runs", type=int, default=5, help="Repetitions per measurement")
+def main(size: int, runs: int) -> None:
+    with engine.connect() as conn:
+        tx = conn.begin()
+        try:
+            for name, shape in (("deep", deep), ("wide", wide), ("tree", tree)):
+                edges = shape(size)
+                rows = [
+                    dict(
+                        source=s,
+                        source_cluster=s,
+                        target=t,
+                        target_cluster=t,
+                        type=LinkType.SAME,
+                        user="benchmark",
+                    )
+                    for (s, t) in edges
+                ]
+                conn.execute(insert(link_table), rows)
+                conn.execute("ANALYZE link")
+                start = _node(name, size - 1)
+                bfs, bfs_time = _time(compute_cluster_bfs, conn, start, runs)
+                cte, cte_time = _time(compute_cluster, conn, start, runs)
+                if bfs != cte:
+                    print(f"{name}: results differ!", file=sys.stderr)
+                    sys.exit(1)
+                print(
+                    f"{name:5} {len(cte):7d} tags  "
+                    f"bfs {bfs_time * 1000:9.1f}ms  "
+                    f"cte {cte_time * 1000:9.1f}ms  "
+                    f"x{bfs_time / max(cte_time, 1e-9):.1f}"
+                )
+        finally:
+            tx.rollback()
+
+
+if __name__ == "__main__":
+    main()
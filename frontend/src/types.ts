@@ -52,6 +52,7 @@ export interface IClusterBase {
 
 export interface ICluster extends IClusterBase {
   articles: number
+  mentions: number
 }
 
 export interface IClusterDetails extends ICluster {
@@ -30,6 +30,7 @@ setup(
         "orjson",
         "fastapi",
         "networkx",
+        "numpy",
         "spacy",
         "python-levenshtein",
         "followthemoney",
@@ -37,6 +38,7 @@ setup(
         "fasttext",
         "uvicorn",
         "trafilatura",
+        "lxml",
         "charset-normalizer",
         "click >= 8.0.0, < 8.2.0",
     ],
@@ -47,6 +49,8 @@ setup(
         ],
     },
     extras_require={
+        "zstd": ["zstandard"],
+        "warc": ["warcio"],
         "dev": [
             "wheel>=0.29.0",
             "twine",
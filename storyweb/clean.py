@@ -1,6 +1,7 @@
 import re
 import Levenshtein
-from typing import List, Optional, Union
+from collections import Counter
+from typing import Iterable, Mapping, Optional, Union
 from normality import collapse_spaces
 
 PREFIXES_RAW_LIST = [
@@ -34,6 +35,11 @@ NAME_PATTERN_ = r"^\W*((%s)\.?\s+)*(?P<term>.*?)([\'’]s)?\W*$"
 NAME_PATTERN_ = NAME_PATTERN_ % PREFIXES_RAW
 PREFIXES = re.compile(NAME_PATTERN_, re.I | re.U)
 
+# Only the most frequent distinct labels are considered for the median:
+MEDIAN_LIMIT = 30
+
+Names = Union[Iterable[str], Mapping[str, int]]
+
 
 def clean_entity_name(name: str) -> Optional[str]:
     match = PREFIXES.match(name)
@@ -42,10 +48,27 @@ def clean_entity_name(name: str) -> Optional[str]:
     return collapse_spaces(name)
 
 
-def most_common(texts: List[str]) -> str:
-    # https://stackoverflow.com/questions/1518522/find-the-most-common-element-in-a-list
-    return max(set(texts), key=texts.count)
+def count_names(names: Names) -> Counter[str]:
+    """Accept either a plain list of names (one per mention) or a mapping of
+    distinct names to their number of occurrences."""
+    if isinstance(names, Counter):
+        return names
+    return Counter(names)
+
+
+def most_common(texts: Names) -> str:
+    counts = count_names(texts)
+    ((text, _),) = counts.most_common(1)
+    return text
 
 
-def pick_name(names: List[Union[str, bytes]]) -> str:
-    return Levenshtein.setmedian(names)
+def pick_name(names: Names, limit: int = MEDIAN_LIMIT) -> str:
+    """Pick the label that best represents all of the given names: the weighted
+    set median of the most frequent distinct names."""
+    counts = count_names(names)
+    if len(counts) == 1:
+        return next(iter(counts))
+    top = counts.most_common(limit)
+    labels = [n for (n, _) in top]
+    weights = [c for (_, c) in top]
+    return Levenshtein.setmedian(labels, weights)
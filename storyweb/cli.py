@@ -1,15 +1,24 @@
+import time
 import click
 import logging
+from datetime import datetime
 from pathlib import Path
-from typing import Optional
+from typing import Any, List, Optional
 from networkx.readwrite.gexf import write_gexf
 
 from storyweb.db import create_db, engine
 from storyweb.logic.links import auto_merge, story_merge
+from storyweb.logic.merge import auto_merge_bulk
 from storyweb.logic.stories import toggle_story_article
 from storyweb.logic.graph import generate_graph
-from storyweb.parse import import_article_by_url
-from storyweb.parse.pipeline import load_articles
+from storyweb.parse import import_article_by_url, import_articles_by_url
+from storyweb.parse.fetch import THREADS
+from storyweb.parse.crawl import crawl_sources, load_sources, RECRAWL_DAYS
+from storyweb.parse.wordpress import import_wordpress
+from storyweb.parse.warc import import_warcs
+from storyweb.parse.pipeline import load_articles, reprocess_articles, import_articles
+from storyweb.parse.pipeline import shard_report
+from storyweb.parse.util import Shard, parse_shard
 
 
 log = logging.getLogger(__name__)
@@ -18,6 +27,15 @@ InPath = click.Path(dir_okay=False, readable=True, path_type=Path)
 OutPath = click.Path(dir_okay=False, readable=True, path_type=Path)
 
 
+def _shard_option(ctx: click.Context, param: click.Parameter, value: Any) -> Any:
+    if value is None:
+        return None
+    try:
+        return parse_shard(value)
+    except ValueError:
+        raise click.BadParameter("must be of the form INDEX/COUNT, e.g. 1/4")
+
+
 @click.group(help="Storyweb CLI")
 def cli() -> None:
     logging.basicConfig(level=logging.INFO)
@@ -25,8 +43,113 @@ def cli() -> None:
 
 @cli.command("import", help="Import articles into the DB")
 @click.argument("articles", type=InPath)
-def parse(articles: Path) -> None:
-    load_articles(articles)
+@click.option(
+    "-w",
+    "--workers",
+    "workers",
+    help="Number of NER worker processes",
+    type=int,
+    default=1,
+)
+@click.option(
+    "--restart",
+    "restart",
+    help="Ignore the checkpoint of an interrupted import",
+    default=False,
+    is_flag=True,
+)
+@click.option(
+    "-f",
+    "--force",
+    "force",
+    help="Re-process articles which have not changed",
+    default=False,
+    is_flag=True,
+)
+@click.option(
+    "--dedupe/--no-dedupe",
+    "dedupe",
+    help="Skip NER for near-duplicates of other articles",
+    default=True,
+)
+@click.option(
+    "--shard",
+    "shard",
+    help="Only import one part of the file, e.g. 2/4 for the second of four",
+    callback=_shard_option,
+)
+@click.option(
+    "--progress",
+    "progress",
+    help="Log the throughput every so many seconds",
+    type=float,
+)
+@click.option(
+    "--report",
+    "report",
+    help="Write a JSON profile of the import stages to this file",
+    type=OutPath,
+)
+def parse(
+    articles: Path,
+    workers: int,
+    restart: bool,
+    force: bool,
+    dedupe: bool,
+    shard: Optional[Shard],
+    progress: Optional[float],
+    report: Optional[Path],
+) -> None:
+    load_articles(
+        articles,
+        workers=workers,
+        resume=not restart,
+        force=force,
+        dedupe=dedupe,
+        shard=shard,
+        progress=progress,
+        report=report,
+    )
+
+
+@cli.command("shard-report", help="Check that all shards of an import are complete")
+@click.argument("articles", type=InPath)
+@click.option(
+    "-n",
+    "--shards",
+    "shards",
+    help="Number of shards the import was split into",
+    type=click.IntRange(min=1),
+    required=True,
+)
+def shard_report_(articles: Path, shards: int) -> None:
+    missing = 0
+    for (shard, expected, imported) in shard_report(articles, shards):
+        log.info("Shard %d/%d: %d of %d articles", shard, shards, imported, expected)
+        missing += expected - imported
+    if missing > 0:
+        raise click.ClickException("%d articles have not been imported" % missing)
+
+
+@cli.command("reprocess", help="Re-run tag extraction for articles in the DB")
+@click.option(
+    "-w",
+    "--workers",
+    "workers",
+    help="Number of NER worker processes",
+    type=int,
+    default=1,
+)
+@click.option("--site", "site", help="Only articles from this site", type=str)
+@click.option("--language", "language", help="Only articles in this language")
+@click.option("-s", "--story", "story", help="Only articles in this story", type=int)
+def reprocess(
+    workers: int,
+    site: Optional[str] = None,
+    language: Optional[str] = None,
+    story: Optional[int] = None,
+) -> None:
+    reprocess_articles(workers=workers, site=site, language=language, story=story)
 
 
 @cli.command("import-url", help="Load a single news story by URL")
@@ -40,6 +163,213 @@ def parse(url: str, story: Optional[int] = None) -> None:
             toggle_story_article(conn, story, article_id, delete_existing=False)
 
 
+@cli.command("import-urls", help="Load news stories from a file of URLs")
+@click.argument("urls", type=InPath)
+@click.option(
+    "-w",
+    "--workers",
+    "workers",
+    help="Number of extraction and NER worker processes",
+    type=int,
+    default=1,
+)
+@click.option(
+    "-t",
+    "--threads",
+    "threads",
+    help="Number of concurrent downloads",
+    type=int,
+    default=THREADS,
+)
+@click.option(
+    "-f",
+    "--force",
+    "force",
+    help="Re-process articles which have not changed",
+    default=False,
+    is_flag=True,
+)
+@click.option("-s", "--story", "story", help="Story ID", type=int)
+def parse_urls(
+    urls: Path,
+    workers: int,
+    threads: int,
+    force: bool,
+    story: Optional[int] = None,
+) -> None:
+    with open(urls, "r") as fh:
+        lines = (line.strip() for line in fh)
+        url_list = [line for line in lines if len(line) and not line.startswith("#")]
+    article_ids = import_articles_by_url(
+        url_list,
+        workers=workers,
+        threads=threads,
+        force=force,
+        dedupe=story is None,
+    )
+    log.info("Imported %d of %d URLs", len(article_ids), len(url_list))
+    if story is not None:
+        with engine.begin() as conn:
+            for article_id in article_ids:
+                story_merge(conn, story, article_id)
+                toggle_story_article(conn, story, article_id, delete_existing=False)
+
+
+@cli.command("crawl", help="Crawl the websites of news sources for articles")
+@click.argument("sources", type=InPath, default="sources.json")
+@click.option(
+    "-o",
+    "--output",
+    "output",
+    help="Append articles to this file instead of importing them",
+    type=OutPath,
+)
+@click.option(
+    "--state",
+    "state",
+    help="Crawler state database, for incremental crawls",
+    type=OutPath,
+    default="crawl.sqlite3",
+)
+@click.option("-n", "--name", "names", help="Only crawl this source", multiple=True)
+@click.option(
+    "-w",
+    "--workers",
+    "workers",
+    help="Number of parser and NER worker processes",
+    type=int,
+    default=1,
+)
+@click.option(
+    "-t",
+    "--threads",
+    "threads",
+    help="Number of concurrent downloads",
+    type=int,
+    default=THREADS,
+)
+@click.option(
+    "--recrawl",
+    "recrawl",
+    help="Fetch known articles again after this many days",
+    type=int,
+    default=RECRAWL_DAYS,
+)
+@click.option("--max-pages", "max_pages", help="Stop after N requests", type=int)
+@click.option(
+    "--every",
+    "every",
+    help="Keep running, starting a new crawl every N minutes",
+    type=int,
+)
+def crawl(
+    sources: Path,
+    output: Optional[Path],
+    state: Path,
+    names: List[str],
+    workers: int,
+    threads: int,
+    recrawl: int,
+    max_pages: Optional[int],
+    every: Optional[int],
+) -> None:
+    source_list = load_sources(sources, names=names)
+    while True:
+        started = time.time()
+        articles = crawl_sources(
+            source_list,
+            state,
+            workers=workers,
+            threads=threads,
+            recrawl_days=recrawl,
+            max_pages=max_pages,
+        )
+        if output is not None:
+            with open(output, "a") as fh:
+                for article in articles:
+                    fh.write(article.json())
+                    fh.write("\n")
+                    fh.flush()
+        else:
+            import_articles(articles, workers=workers, context="spawn")
+        if every is None:
+            break
+        time.sleep(max(0, (every * 60) - (time.time() - started)))
+
+
+@cli.command("import-warc", help="Import articles from WARC archives")
+@click.argument("warcs", type=InPath, nargs=-1, required=True)
+@click.option(
+    "-w",
+    "--workers",
+    "workers",
+    help="Number of extraction and NER worker processes",
+    type=int,
+    default=1,
+)
+@click.option(
+    "-f",
+    "--force",
+    "force",
+    help="Re-process articles which have not changed",
+    default=False,
+    is_flag=True,
+)
+def import_warc(warcs: List[Path], workers: int, force: bool) -> None:
+    article_ids = import_warcs(warcs, workers=workers, force=force)
+    log.info("Imported %d articles from %d archives", len(article_ids), len(warcs))
+
+
+@cli.command("import-wp", help="Import posts from WordPress sites via their API")
+@click.argument("sources", type=InPath, default="sources.json")
+@click.option("-n", "--name", "names", help="Only import this source", multiple=True)
+@click.option(
+    "-w",
+    "--workers",
+    "workers",
+    help="Number of NER worker processes",
+    type=int,
+    default=1,
+)
+@click.option(
+    "-t",
+    "--threads",
+    "threads",
+    help="Number of concurrent API requests",
+    type=int,
+    default=THREADS,
+)
+@click.option(
+    "--since",
+    "since",
+    help="Only posts modified after this date",
+    type=click.DateTime(),
+)
+@click.option(
+    "--full",
+    "full",
+    help="Fetch all posts, not just those modified since the last sync",
+    default=False,
+    is_flag=True,
+)
+def import_wp(
+    sources: Path,
+    names: List[str],
+    workers: int,
+    threads: int,
+    since: Optional[datetime],
+    full: bool,
+) -> None:
+    source_list = load_sources(sources, names=names)
+    import_wordpress(
+        source_list,
+        workers=workers,
+        threads=threads,
+        since=since,
+        full=full,
+    )
+
+
 @cli.command("graph", help="Export an entity graph")
 @click.argument("graph_path", type=OutPath)
 def export_graph(graph_path: Path) -> None:
@@ -70,9 +400,20 @@ def compute() -> None:
     default=False,
     is_flag=True,
 )
-def auto_merge_(force: bool) -> None:
+@click.option(
+    "--bulk",
+    "bulk",
+    help="Compute all clusters in memory and write them back at once",
+    default=False,
+    is_flag=True,
+)
+def auto_merge_(force: bool, bulk: bool) -> None:
     with engine.begin() as conn:
-        auto_merge(conn, check_links=force)
+        if bulk:
+            created = auto_merge_bulk(conn, check_links=not force)
+            log.info("Auto-merge created %d links", created)
+        else:
+            auto_merge(conn, check_links=not force)
 
 
 @cli.command("init", help="Initialize the database")
@@ -1,8 +1,10 @@
 import logging
 from sqlalchemy import MetaData, create_engine
-from sqlalchemy import Table, Column, Integer, Unicode, DateTime, Float
+from sqlalchemy import Table, Column, Integer, BigInteger, Unicode, DateTime, Float
+from sqlalchemy import LargeBinary, Index
 from sqlalchemy.engine import Connection
-from sqlalchemy.dialects.postgresql import insert as upsert
+from sqlalchemy.sql import text
+from sqlalchemy.dialects.postgresql import ARRAY, insert as upsert
 
 from storyweb import settings
 
@@ -15,9 +17,138 @@ meta = MetaData(bind=engine)
 
 __all__ = ["Conn", "upsert", "create_db"]
 
+# Schema changes to tables which already exist in a database, which `create_all`
+# will not apply. All of these must be safe to run repeatedly.
+UPGRADES = [
+    "ALTER TABLE article ADD COLUMN IF NOT EXISTS hash VARCHAR(40)",
+    "ALTER TABLE article ADD COLUMN IF NOT EXISTS duplicate_of VARCHAR(255)",
+    # Sentences used to be stored as a copy of their text, now they're offsets
+    # into the article text. Existing rows are located in their article, and those
+    # which cannot be found are dropped (`storyweb reprocess` re-creates them):
+    "ALTER TABLE sentence ADD COLUMN IF NOT EXISTS start_char INTEGER",
+    "ALTER TABLE sentence ADD COLUMN IF NOT EXISTS end_char INTEGER",
+    """
+    DO $$
+    BEGIN
+        IF EXISTS (
+            SELECT 1 FROM information_schema.columns
+            WHERE table_name = 'sentence' AND column_name = 'text'
+        ) THEN
+            UPDATE sentence s
+                SET start_char = strpos(a.text, s.text) - 1,
+                    end_char = strpos(a.text, s.text) - 1 + length(s.text)
+                FROM article a
+                WHERE a.id = s.article AND strpos(a.text, s.text) > 0;
+            DELETE FROM sentence WHERE start_char IS NULL;
+            ALTER TABLE sentence DROP COLUMN text;
+        END IF;
+    END $$
+    """,
+    # Indexes on the link table, for resolving clusters along SAME links:
+    "CREATE INDEX IF NOT EXISTS ix_link_same_source ON link (source, target) "
+    "WHERE type = 'SAME'",
+    "CREATE INDEX IF NOT EXISTS ix_link_same_target ON link (target, source) "
+    "WHERE type = 'SAME'",
+    "CREATE INDEX IF NOT EXISTS ix_link_source_cluster ON link (source_cluster)",
+    "CREATE INDEX IF NOT EXISTS ix_link_target_cluster ON link (target_cluster)",
+    # Cluster membership used to be kept in columns of the tag table, which are
+    # moved to the `tag_cluster` and `cluster` tables:
+    """
+    DO $$
+    BEGIN
+        IF EXISTS (
+            SELECT 1 FROM information_schema.columns
+            WHERE table_name = 'tag' AND column_name = 'cluster'
+        ) THEN
+            INSERT INTO tag_cluster (tag, cluster, article)
+                SELECT id, cluster, article FROM tag
+                ON CONFLICT DO NOTHING;
+            INSERT INTO cluster (id, type, label, articles, labels)
+                SELECT cluster, MAX(cluster_type), MAX(cluster_label),
+                    COUNT(DISTINCT article), ARRAY_AGG(DISTINCT label)
+                FROM tag GROUP BY cluster
+                ON CONFLICT DO NOTHING;
+            ALTER TABLE tag DROP COLUMN cluster;
+            ALTER TABLE tag DROP COLUMN cluster_type;
+            ALTER TABLE tag DROP COLUMN cluster_label;
+        END IF;
+    END $$
+    """,
+    # Cluster statistics which were added later, filled in once:
+    "ALTER TABLE cluster ADD COLUMN IF NOT EXISTS mentions INTEGER",
+    """
+    DO $$
+    BEGIN
+        IF EXISTS (SELECT 1 FROM cluster WHERE mentions IS NULL) THEN
+            UPDATE cluster c SET mentions = m.mentions
+                FROM (
+                    SELECT tc.cluster, SUM(t.count) AS mentions
+                    FROM tag_cluster tc JOIN tag t ON t.id = tc.tag
+                    GROUP BY tc.cluster
+                ) m
+                WHERE m.cluster = c.id;
+        END IF;
+    END $$
+    """,
+    # The cluster listing is sorted by article count, optionally within a type:
+    "DROP INDEX IF EXISTS ix_cluster_type",
+    "DROP INDEX IF EXISTS ix_cluster_articles",
+    "CREATE INDEX IF NOT EXISTS ix_cluster_listing ON cluster (articles DESC, id)",
+    "CREATE INDEX IF NOT EXISTS ix_cluster_type_listing "
+    "ON cluster (type, articles DESC, id)",
+    """
+    INSERT INTO cluster_type (type, clusters)
+        SELECT type, COUNT(*) FROM cluster
+        WHERE type IS NOT NULL AND NOT EXISTS (SELECT 1 FROM cluster_type)
+        GROUP BY type
+    """,
+    "ALTER TABLE checkpoint ADD COLUMN IF NOT EXISTS size BIGINT",
+    "ALTER TABLE checkpoint ADD COLUMN IF NOT EXISTS mtime BIGINT",
+    # WordPress sync cursors used to be kept as checkpoints:
+    """
+    INSERT INTO sync_cursor (source, modified_after, updated_at)
+        SELECT source, to_timestamp(position) AT TIME ZONE 'UTC', updated_at
+        FROM checkpoint WHERE source LIKE 'wp:%'
+        ON CONFLICT DO NOTHING
+    """,
+    "DELETE FROM checkpoint WHERE source LIKE 'wp:%'",
+    # Substring search uses trigram indexes where the pg_trgm extension can be
+    # installed. Without it, searches give the same results but scan the tables:
+    """
+    DO $$
+    BEGIN
+        CREATE EXTENSION IF NOT EXISTS pg_trgm;
+    EXCEPTION WHEN OTHERS THEN
+        RAISE NOTICE 'The pg_trgm extension is not available, search is unindexed';
+    END $$
+    """,
+    "ALTER TABLE cluster ADD COLUMN IF NOT EXISTS search VARCHAR",
+    "UPDATE cluster SET search = array_to_string(labels, E'\\n') WHERE search IS NULL",
+    """
+    DO $$
+    BEGIN
+        IF EXISTS (SELECT 1 FROM pg_extension WHERE extname = 'pg_trgm') THEN
+            CREATE INDEX IF NOT EXISTS ix_cluster_search
+                ON cluster USING gin (search gin_trgm_ops);
+            CREATE INDEX IF NOT EXISTS ix_article_title_search
+                ON article USING gin (title gin_trgm_ops);
+            CREATE INDEX IF NOT EXISTS ix_story_title_search
+                ON story USING gin (title gin_trgm_ops);
+        END IF;
+    END $$
+    """,
+]
+
 
 def create_db() -> None:
     meta.create_all(checkfirst=True)
+    upgrade_db()
+
+
+def upgrade_db() -> None:
+    with engine.begin() as conn:
+        for upgrade in UPGRADES:
+            conn.execute(text(upgrade))
 
 
 article_table = Table(
@@ -31,6 +162,8 @@ article_table = Table(
     Column("text", Unicode, nullable=True),
     Column("tags", Integer, default=0),
     Column("mentions", Integer, default=0),
+    Column("hash", Unicode(KEY_LEN), nullable=True),
+    Column("duplicate_of", Unicode(255), nullable=True),
 )
 
 story_table = Table(
@@ -53,24 +186,58 @@ sentence_table = Table(
     meta,
     Column("article", Unicode(255), primary_key=True),
     Column("sequence", Integer, primary_key=True),
-    Column("text", Unicode),
+    Column("start_char", Integer),
+    Column("end_char", Integer),
 )
 
 tag_table = Table(
     "tag",
     meta,
     Column("id", Unicode(KEY_LEN), primary_key=True),
-    Column("cluster", Unicode(KEY_LEN), index=True),
     Column("article", Unicode(255), index=True),
     Column("fingerprint", Unicode(1024), index=True),
     Column("type", Unicode(10)),
-    Column("cluster_type", Unicode(10)),
     Column("label", Unicode),
-    Column("cluster_label", Unicode),
     Column("count", Integer),
     Column("frequency", Float),
 )
 
+# The cluster each tag belongs to. Merging clusters only rewrites these narrow
+# rows, and the article is kept here so that clusters can be joined on their
+# articles without going through the tag table.
+tag_cluster_table = Table(
+    "tag_cluster",
+    meta,
+    Column("tag", Unicode(KEY_LEN), primary_key=True),
+    Column("cluster", Unicode(KEY_LEN), index=True, nullable=False),
+    Column("article", Unicode(255), index=True, nullable=False),
+)
+
+# Clusters with their statistics, which are refreshed whenever their membership
+# changes. The indexes follow the sort order of the cluster listing.
+cluster_table = Table(
+    "cluster",
+    meta,
+    Column("id", Unicode(KEY_LEN), primary_key=True),
+    Column("type", Unicode(10)),
+    Column("label", Unicode),
+    Column("articles", Integer),
+    Column("labels", ARRAY(Unicode)),
+    Column("mentions", Integer),
+    # All labels of the cluster, one per line, for substring search:
+    Column("search", Unicode),
+    Index("ix_cluster_listing", text("articles DESC"), "id"),
+    Index("ix_cluster_type_listing", "type", text("articles DESC"), "id"),
+)
+
+# The number of clusters of each type, kept up to date with the cluster table.
+cluster_type_table = Table(
+    "cluster_type",
+    meta,
+    Column("type", Unicode(10), primary_key=True),
+    Column("clusters", Integer, nullable=False),
+)
+
 tag_sentence_table = Table(
     "tag_sentence",
     meta,
@@ -79,14 +246,60 @@ tag_sentence_table = Table(
     Column("tag", Unicode(KEY_LEN), primary_key=True),
 )
 
+mention_table = Table(
+    "mention",
+    meta,
+    Column("article", Unicode(255), primary_key=True),
+    Column("start_char", Integer, primary_key=True),
+    Column("end_char", Integer),
+    Column("tag", Unicode(KEY_LEN), index=True),
+)
+
 link_table = Table(
     "link",
     meta,
     Column("source", Unicode(KEY_LEN), primary_key=True),
-    Column("source_cluster", Unicode(KEY_LEN)),
+    Column("source_cluster", Unicode(KEY_LEN), index=True),
     Column("target", Unicode(KEY_LEN), primary_key=True),
-    Column("target_cluster", Unicode(KEY_LEN)),
+    Column("target_cluster", Unicode(KEY_LEN), index=True),
     Column("type", Unicode(255)),
     Column("user", Unicode(255), nullable=True),
     Column("timestamp", DateTime),
 )
+
+minhash_table = Table(
+    "minhash",
+    meta,
+    Column("article", Unicode(255), primary_key=True),
+    Column("signature", LargeBinary, nullable=False),
+)
+
+minhash_band_table = Table(
+    "minhash_band",
+    meta,
+    Column("band", Integer, primary_key=True),
+    Column("bucket", BigInteger, primary_key=True),
+    Column("article", Unicode(255), primary_key=True, index=True),
+)
+
+# The byte offset in a source file up to which an import has been saved, along
+# with the size and modification time (in ns) of the file at that point.
+checkpoint_table = Table(
+    "checkpoint",
+    meta,
+    Column("source", Unicode, primary_key=True),
+    Column("position", BigInteger, nullable=False),
+    Column("size", BigInteger, nullable=True),
+    Column("mtime", BigInteger, nullable=True),
+    Column("updated_at", DateTime),
+)
+
+# The modification time (UTC) up to which the posts of a WordPress site have
+# been imported.
+sync_cursor_table = Table(
+    "sync_cursor",
+    meta,
+    Column("source", Unicode, primary_key=True),
+    Column("modified_after", DateTime, nullable=False),
+    Column("updated_at", DateTime),
+)
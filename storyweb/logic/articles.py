@@ -1,18 +1,26 @@
 import logging
-from typing import Iterable, List, Optional
-from sqlalchemy.sql import select, delete, insert, func
+from typing import Any, Dict, Generator, Iterable, List, Optional, Sequence
+from sqlalchemy import Table
+from sqlalchemy.sql import FromClause, select, delete, insert, func, literal
+from sqlalchemy.dialects.postgresql import array
 
 from storyweb.db import Conn, upsert
 from storyweb.db import article_table, sentence_table
-from storyweb.db import tag_table, tag_sentence_table
-from storyweb.db import story_article_table
-from storyweb.logic.util import count_stmt
+from storyweb.db import tag_table, tag_sentence_table, mention_table
+from storyweb.db import tag_cluster_table, cluster_table
+from storyweb.db import story_article_table, link_table
+from storyweb.logic.links import count_cluster_types, refresh_clusters
+from storyweb.logic.util import count_stmt, copy_rows, create_stage
+from storyweb.logic.util import search_filter, search_rank
 from storyweb.models import (
     ArticleDetails,
+    ArticleMention,
+    ExtractedArticle,
     Link,
     Article,
     Listing,
     ListingResponse,
+    Mention,
     Sentence,
     Site,
     Tag,
@@ -63,7 +71,7 @@ def list_articles(
     if site is not None and len(site.strip()):
         stmt = stmt.where(article_table.c.site == site)
     if query is not None and len(query.strip()):
-        stmt = stmt.where(article_table.c.title.ilike(f"%{query}%"))
+        stmt = stmt.where(search_filter(article_table.c.title, query))
     if story is not None:
         stmt = stmt.join(
             story_article_table,
@@ -71,7 +79,7 @@ def list_articles(
         )
         stmt = stmt.where(story_article_table.c.story == story)
     for cluster in clusters:
-        cluster_t = tag_table.alias()
+        cluster_t = tag_cluster_table.alias()
         stmt = stmt.join(cluster_t, cluster_t.c.article == article_table.c.id)
         stmt = stmt.where(cluster_t.c.cluster == cluster)
 
@@ -82,6 +90,8 @@ def list_articles(
             stmt = stmt.order_by(column.desc())
         else:
             stmt = stmt.order_by(column.asc())
+    elif query is not None and len(query.strip()):
+        stmt = stmt.order_by(search_rank(article_table.c.title, query))
     stmt = stmt.group_by(
         article_table.c.id,
         article_table.c.title,
@@ -114,6 +124,68 @@ def fetch_article(conn: Conn, article_id: str) -> Optional[ArticleDetails]:
     return ArticleDetails.parse_obj(obj)
 
 
+def fetch_sentences(conn: Conn, article: ArticleDetails) -> List[Sentence]:
+    """Get the tagged sentences of an article, slicing their text from the
+    article text."""
+    stmt = select(sentence_table)
+    stmt = stmt.where(sentence_table.c.article == article.id)
+    stmt = stmt.order_by(sentence_table.c.sequence)
+    sentences: List[Sentence] = []
+    for row in conn.execute(stmt):
+        sentence = Sentence.parse_obj(row)
+        sentence.text = article.text[sentence.start_char : sentence.end_char]
+        sentences.append(sentence)
+    return sentences
+
+
+def list_mentions(conn: Conn, article_id: str) -> List[ArticleMention]:
+    """Get the entity mentions in an article, in text order, with the cluster
+    each of them currently belongs to."""
+    stmt = select(
+        mention_table,
+        cluster_table.c.id.label("cluster"),
+        cluster_table.c.type.label("cluster_type"),
+        cluster_table.c.label.label("cluster_label"),
+    )
+    stmt = stmt.join(
+        tag_cluster_table,
+        tag_cluster_table.c.tag == mention_table.c.tag,
+    )
+    stmt = stmt.join(cluster_table, cluster_table.c.id == tag_cluster_table.c.cluster)
+    stmt = stmt.where(mention_table.c.article == article_id)
+    stmt = stmt.order_by(mention_table.c.start_char)
+    cursor = conn.execute(stmt)
+    return [ArticleMention.parse_obj(r) for r in cursor.fetchall()]
+
+
+def stream_articles(
+    conn: Conn,
+    site: Optional[str] = None,
+    language: Optional[str] = None,
+    story: Optional[int] = None,
+) -> Generator[ArticleDetails, None, None]:
+    """Iterate over the stored articles using a server-side cursor."""
+    stmt = select(article_table)
+    if site is not None:
+        stmt = stmt.where(article_table.c.site == site)
+    if language is not None:
+        stmt = stmt.where(article_table.c.language == language)
+    if story is not None:
+        stmt = stmt.join(
+            story_article_table,
+            story_article_table.c.article == article_table.c.id,
+        )
+        stmt = stmt.where(story_article_table.c.story == story)
+    stmt = stmt.order_by(article_table.c.id)
+    cursor = conn.execution_options(stream_results=True).execute(stmt)
+    while True:
+        rows = cursor.fetchmany(1000)
+        if not rows:
+            break
+        for row in rows:
+            yield ArticleDetails.parse_obj(row)
+
+
 def save_article(conn: Conn, article: ArticleDetails) -> None:
     istmt = upsert(article_table).values([article.dict()])
     values = dict(
@@ -122,6 +194,10 @@ def save_article(conn: Conn, article: ArticleDetails) -> None:
         title=istmt.excluded.title,
         language=istmt.excluded.language,
         text=istmt.excluded.text,
+        tags=istmt.excluded.tags,
+        mentions=istmt.excluded.mentions,
+        hash=istmt.excluded.hash,
+        duplicate_of=istmt.excluded.duplicate_of,
     )
     stmt = istmt.on_conflict_do_update(index_elements=["id"], set_=values)
     conn.execute(stmt)
@@ -133,12 +209,13 @@ def save_extracted(
     sentences: Iterable[Sentence],
     tag_sentences: Iterable[TagSentence],
     tags: Iterable[Tag],
+    mentions: Iterable[Mention],
 ) -> None:
     save_article(conn, article)
     stmt = delete(sentence_table)
     stmt = stmt.where(sentence_table.c.article == article.id)
     conn.execute(stmt)
-    sentence_values = [s.dict() for s in sentences]
+    sentence_values = [s.dict(exclude={"text"}) for s in sentences]
     if len(sentence_values):
         sstmt = insert(sentence_table).values(sentence_values)
         conn.execute(sstmt)
@@ -151,6 +228,14 @@ def save_extracted(
         sstmt = insert(tag_sentence_table).values(tag_sentence_values)
         conn.execute(sstmt)
 
+    stmt = delete(mention_table)
+    stmt = stmt.where(mention_table.c.article == article.id)
+    conn.execute(stmt)
+    mention_values = [m.dict() for m in mentions]
+    if len(mention_values):
+        sstmt = insert(mention_table).values(mention_values)
+        conn.execute(sstmt)
+
     tag_values = [t.dict() for t in tags]
     if len(tag_values):
         istmt = upsert(tag_table).values(tag_values)
@@ -162,6 +247,158 @@ def save_extracted(
         )
         ustmt = istmt.on_conflict_do_update(index_elements=["id"], set_=updates)
         conn.execute(ustmt)
+        ids = [t["id"] for t in tag_values]
+        saved = select(tag_table).where(tag_table.c.id.in_(ids)).subquery()
+        add_tag_clusters(conn, saved)
+
+
+def add_tag_clusters(conn: Conn, tags: FromClause) -> None:
+    """Make each of the given tags which is not yet a member of a cluster the
+    only member of a new cluster. The clusters of the tags which already are
+    members are refreshed, since the label, type or count of a tag changes when
+    its article is imported or extracted again."""
+    existing = select(tag_cluster_table.c.cluster).distinct()
+    existing = existing.where(tag_cluster_table.c.tag.in_(select(tags.c.id)))
+    clusters = conn.execute(existing).scalars().all()
+    if len(clusters):
+        refresh_clusters(conn, clusters)
+
+    member = select(tag_cluster_table.c.tag)
+    member = member.where(tag_cluster_table.c.tag == tags.c.id)
+    fresh = select(
+        tags.c.id,
+        tags.c.type,
+        tags.c.label,
+        literal(1),
+        array([tags.c.label]),
+        tags.c.count,
+        tags.c.label,
+    )
+    fresh = fresh.where(~member.exists())
+    columns = [c.name for c in cluster_table.columns]
+    istmt = upsert(cluster_table).from_select(columns, fresh)
+    istmt = istmt.on_conflict_do_nothing().returning(cluster_table.c.type)
+    count_cluster_types(conn, conn.execute(istmt).scalars())
+
+    members = select(tags.c.id, tags.c.id, tags.c.article)
+    columns = [c.name for c in tag_cluster_table.columns]
+    istmt = upsert(tag_cluster_table).from_select(columns, members)
+    conn.execute(istmt.on_conflict_do_nothing())
+
+
+def _table_row(table: Table, values: Dict[str, Any]) -> Sequence[Any]:
+    return [values.get(c.name) for c in table.columns]
+
+
+def save_extracted_batch(
+    conn: Conn, batch: Iterable[ExtractedArticle], prune: bool = False
+) -> None:
+    """Write a batch of extracted articles in a handful of set-based statements.
+    All rows are loaded into temporary staging tables via `COPY` and then merged
+    into the main tables, with the same semantics as `save_extracted`. If `prune`
+    is set, tags of these articles which were not extracted again are removed,
+    unless they are referenced by a link. The tags of near-duplicate articles,
+    which are not extracted at all, are always pruned."""
+    # If an article occurs more than once, the last version wins:
+    articles: Dict[str, ExtractedArticle] = {}
+    for extracted in batch:
+        articles[extracted.article.id] = extracted
+    if not len(articles):
+        return
+
+    stages = create_stage(
+        conn,
+        article_table,
+        sentence_table,
+        tag_sentence_table,
+        tag_table,
+        mention_table,
+    )
+    article_stage, sentence_stage, tag_sentence_stage, tag_stage, mention_stage = stages
+    items = articles.values()
+    copy_rows(
+        conn,
+        article_stage,
+        (_table_row(article_table, e.article.dict()) for e in items),
+    )
+    copy_rows(
+        conn,
+        sentence_stage,
+        (_table_row(sentence_table, s.dict()) for e in items for s in e.sentences),
+    )
+    copy_rows(
+        conn,
+        tag_sentence_stage,
+        (
+            _table_row(tag_sentence_table, s.dict())
+            for e in items
+            for s in e.tag_sentences
+        ),
+    )
+    copy_rows(
+        conn,
+        tag_stage,
+        (_table_row(tag_table, t.dict()) for e in items for t in e.tags),
+    )
+    copy_rows(
+        conn,
+        mention_stage,
+        (_table_row(mention_table, m.dict()) for e in items for m in e.mentions),
+    )
+
+    columns = [c.name for c in article_table.columns]
+    istmt = upsert(article_table).from_select(columns, select(article_stage))
+    values = dict(
+        site=istmt.excluded.site,
+        url=istmt.excluded.url,
+        title=istmt.excluded.title,
+        language=istmt.excluded.language,
+        text=istmt.excluded.text,
+        tags=istmt.excluded.tags,
+        mentions=istmt.excluded.mentions,
+        hash=istmt.excluded.hash,
+        duplicate_of=istmt.excluded.duplicate_of,
+    )
+    conn.execute(istmt.on_conflict_do_update(index_elements=["id"], set_=values))
+
+    stage_ids = select(article_stage.c.id)
+    for table, stage in (
+        (sentence_table, sentence_stage),
+        (tag_sentence_table, tag_sentence_stage),
+        (mention_table, mention_stage),
+    ):
+        dstmt = delete(table).where(table.c.article.in_(stage_ids))
+        conn.execute(dstmt)
+        columns = [c.name for c in table.columns]
+        conn.execute(insert(table).from_select(columns, select(stage)))
+
+    columns = [c.name for c in tag_table.columns]
+    istmt = upsert(tag_table).from_select(columns, select(tag_stage))
+    updates = dict(
+        type=istmt.excluded.type,
+        label=istmt.excluded.label,
+        count=istmt.excluded.count,
+        frequency=istmt.excluded.frequency,
+    )
+    conn.execute(istmt.on_conflict_do_update(index_elements=["id"], set_=updates))
+    add_tag_clusters(conn, tag_stage)
+
+    prune_ids = stage_ids
+    if not prune:
+        prune_ids = prune_ids.where(article_stage.c.duplicate_of.is_not(None))
+    if prune or any(e.article.duplicate_of is not None for e in items):
+        linked = select(link_table.c.source).union(select(link_table.c.target))
+        dstmt = delete(tag_table)
+        dstmt = dstmt.where(tag_table.c.article.in_(prune_ids))
+        dstmt = dstmt.where(tag_table.c.id.not_in(select(tag_stage.c.id)))
+        dstmt = dstmt.where(tag_table.c.id.not_in(linked))
+        pruned = list(conn.execute(dstmt.returning(tag_table.c.id)).scalars())
+        if len(pruned):
+            mstmt = delete(tag_cluster_table)
+            mstmt = mstmt.where(tag_cluster_table.c.tag.in_(pruned))
+            mstmt = mstmt.returning(tag_cluster_table.c.cluster)
+            refresh_clusters(conn, set(conn.execute(mstmt).scalars()))
+            log.info("Removed %d stale tags", len(pruned))
 
 
 # def compute_idf(conn: Conn):
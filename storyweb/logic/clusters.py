@@ -1,12 +1,13 @@
 import logging
 from datetime import datetime
-from typing import List, Optional, Set
-from sqlalchemy.sql import select, delete, update, func, or_, and_
+from typing import List, Optional
+from sqlalchemy.sql import select, delete, func, or_, and_
 
 from storyweb.db import Conn
-from storyweb.db import tag_table, link_table, story_article_table
-from storyweb.clean import most_common
-from storyweb.logic.util import count_stmt
+from storyweb.db import tag_table, tag_cluster_table, cluster_table
+from storyweb.db import cluster_type_table
+from storyweb.db import link_table, story_article_table
+from storyweb.logic.util import count_stmt, search_filter, search_rank
 from storyweb.models import (
     Cluster,
     ClusterDetails,
@@ -20,10 +21,20 @@ from storyweb.models import (
 )
 from storyweb.ontology import LinkType
 from storyweb.logic.links import clear_links, save_links
+from storyweb.logic.links import compute_cluster, update_cluster
 
 log = logging.getLogger(__name__)
 
 
+def count_clusters(conn: Conn, types: List[str] = []) -> int:
+    """The number of clusters, optionally of the given types only, from the
+    totals which are kept per type."""
+    stmt = select(func.coalesce(func.sum(cluster_type_table.c.clusters), 0))
+    if len(types):
+        stmt = stmt.where(cluster_type_table.c.type.in_(types))
+    return int(conn.execute(stmt).scalar_one())
+
+
 def list_clusters(
     conn: Conn,
     listing: Listing,
@@ -32,42 +43,46 @@ def list_clusters(
     story: Optional[str] = None,
     types: List[str] = [],
 ) -> ListingResponse[Cluster]:
-    cluster_t = tag_table.alias("c")
-    articles = func.count(func.distinct(cluster_t.c.article))
+    cluster_t = cluster_table.alias("c")
     stmt = select(
-        cluster_t.c.cluster.label("id"),
-        cluster_t.c.cluster_type.label("type"),
-        cluster_t.c.cluster_label.label("label"),
-        articles.label("articles"),
+        cluster_t.c.id,
+        cluster_t.c.type,
+        cluster_t.c.label,
+        cluster_t.c.articles,
+        cluster_t.c.mentions,
     )
+    filtered = False
+    ranks = []
 
     if len(types):
-        stmt = stmt.where(cluster_t.c.cluster_type.in_(types))
+        stmt = stmt.where(cluster_t.c.type.in_(types))
 
     if query is not None and len(query.strip()):
-        text_t = tag_table.alias("q")
-        stmt = stmt.where(text_t.c.cluster == cluster_t.c.cluster)
-        stmt = stmt.where(text_t.c.label.ilike(f"%{query}%"))
+        stmt = stmt.where(search_filter(cluster_t.c.search, query))
+        ranks.append(search_rank(cluster_t.c.search, query))
+        filtered = True
 
     if article is not None and len(article.strip()):
-        article_t = tag_table.alias("a")
-        stmt = stmt.where(article_t.c.cluster == cluster_t.c.cluster)
-        stmt = stmt.where(article_t.c.article == article)
+        article_t = tag_cluster_table.alias("a")
+        members = select(article_t.c.cluster)
+        members = members.where(article_t.c.article == article)
+        stmt = stmt.where(cluster_t.c.id.in_(members))
+        filtered = True
 
     if story is not None and len(story.strip()):
         sa_t = story_article_table.alias("sat")
-        article_t = tag_table.alias("sa")
-        stmt = stmt.where(article_t.c.cluster == cluster_t.c.cluster)
-        stmt = stmt.where(article_t.c.article == sa_t.c.article)
-        stmt = stmt.where(sa_t.c.story == story)
-
-    total = count_stmt(conn, stmt, func.distinct(cluster_t.c.cluster))
-    stmt = stmt.group_by(
-        cluster_t.c.cluster,
-        cluster_t.c.cluster_label,
-        cluster_t.c.cluster_type,
-    )
-    stmt = stmt.order_by(articles.desc())
+        article_t = tag_cluster_table.alias("sa")
+        members = select(article_t.c.cluster)
+        members = members.where(article_t.c.article == sa_t.c.article)
+        members = members.where(sa_t.c.story == story)
+        stmt = stmt.where(cluster_t.c.id.in_(members))
+        filtered = True
+
+    if filtered:
+        total = count_stmt(conn, stmt, cluster_t.c.id)
+    else:
+        total = count_clusters(conn, types)
+    stmt = stmt.order_by(*ranks, cluster_t.c.articles.desc(), cluster_t.c.id)
     stmt = stmt.limit(listing.limit).offset(listing.offset)
     cursor = conn.execute(stmt)
     return ListingResponse[Cluster](
@@ -80,23 +95,12 @@ def list_clusters(
 
 
 def fetch_cluster(conn: Conn, id: str) -> Optional[ClusterDetails]:
-    # TODO: should this do an OR on cluster ID?
-    cluster_t = tag_table.alias("c")
-    articles = func.count(func.distinct(cluster_t.c.article))
-    labels = func.array_agg(func.distinct(cluster_t.c.label))
-    stmt = select(
-        cluster_t.c.cluster.label("id"),
-        cluster_t.c.cluster_type.label("type"),
-        cluster_t.c.cluster_label.label("label"),
-        articles.label("articles"),
-        labels.label("labels"),
-    )
-    stmt = stmt.where(or_(cluster_t.c.id == id, cluster_t.c.cluster == id))
-    stmt = stmt.group_by(
-        cluster_t.c.cluster,
-        cluster_t.c.cluster_label,
-        cluster_t.c.cluster_type,
-    )
+    # Cluster IDs are the IDs of one of their tags, so this also resolves the
+    # cluster of a tag:
+    member = select(tag_cluster_table.c.cluster)
+    member = member.where(tag_cluster_table.c.tag == id)
+    stmt = select(cluster_table)
+    stmt = stmt.where(cluster_table.c.id == member.scalar_subquery())
     cursor = conn.execute(stmt)
     for row in cursor.fetchall():
         return ClusterDetails.parse_obj(row)
@@ -104,26 +108,33 @@ def fetch_cluster(conn: Conn, id: str) -> Optional[ClusterDetails]:
 
 
 def list_similar(conn: Conn, listing: Listing, cluster: str):
-    stmt_fp = select(func.distinct(tag_table.c.fingerprint).label("fingerprint"))
-    stmt_fp = stmt_fp.where(tag_table.c.cluster == cluster)
+    member_t = tag_cluster_table.alias("m")
+    tag_t = tag_table.alias("t")
+    stmt_fp = select(func.distinct(tag_t.c.fingerprint).label("fingerprint"))
+    stmt_fp = stmt_fp.join(member_t, member_t.c.tag == tag_t.c.id)
+    stmt_fp = stmt_fp.where(member_t.c.cluster == cluster)
     cte_fp = stmt_fp.cte("fingerprints")
 
     # TODO: add using TF/IDF
     tag_cluster = tag_table.alias("tcl")
+    member_cluster = tag_cluster_table.alias("mcl")
     tag_coref = tag_table.alias("tco")
     stmt_co = select(func.distinct(tag_coref.c.fingerprint).label("fingerprint"))
-    stmt_co = stmt_co.where(tag_cluster.c.article == tag_coref.c.article)
+    stmt_co = stmt_co.where(member_cluster.c.tag == tag_cluster.c.id)
+    stmt_co = stmt_co.where(member_cluster.c.article == tag_coref.c.article)
     stmt_co = stmt_co.where(tag_cluster.c.fingerprint != tag_coref.c.fingerprint)
-    stmt_co = stmt_co.where(tag_cluster.c.cluster == cluster)
+    stmt_co = stmt_co.where(member_cluster.c.cluster == cluster)
     # stmt_co = stmt_co.group_by(tag_coref.c.fingerprint)
     cte_co = stmt_co.cte("coref")
 
     other_cluster = tag_table.alias("ocl")
+    other_member = tag_cluster_table.alias("omb")
     other_coref = tag_table.alias("oco")
+    cluster_t = cluster_table.alias("c")
     stmt = select(
-        other_cluster.c.cluster.label("id"),
-        other_cluster.c.cluster_label.label("label"),
-        other_cluster.c.cluster_type.label("type"),
+        cluster_t.c.id,
+        cluster_t.c.label,
+        cluster_t.c.type,
         func.array_agg(func.distinct(other_coref.c.label)).label("common"),
         func.count(other_coref.c.id).label("common_count"),
     )
@@ -131,12 +142,14 @@ def list_similar(conn: Conn, listing: Listing, cluster: str):
     stmt = stmt.join(other_coref, other_coref.c.fingerprint == cte_co.c.fingerprint)
     stmt = stmt.join(other_cluster, other_cluster.c.article == other_coref.c.article)
     stmt = stmt.join(cte_fp, cte_fp.c.fingerprint == other_cluster.c.fingerprint)
-    stmt = stmt.where(other_cluster.c.cluster != cluster)
-    total = count_stmt(conn, stmt, func.distinct(other_cluster.c.cluster))
+    stmt = stmt.join(other_member, other_member.c.tag == other_cluster.c.id)
+    stmt = stmt.join(cluster_t, cluster_t.c.id == other_member.c.cluster)
+    stmt = stmt.where(other_member.c.cluster != cluster)
+    total = count_stmt(conn, stmt, func.distinct(cluster_t.c.id))
     stmt = stmt.group_by(
-        other_cluster.c.cluster,
-        other_cluster.c.cluster_label,
-        other_cluster.c.cluster_type,
+        cluster_t.c.id,
+        cluster_t.c.label,
+        cluster_t.c.type,
     )
     stmt = stmt.order_by(func.count(other_coref.c.id).desc())
 
@@ -160,22 +173,24 @@ def list_related(
     types: List[str] = [],
 ) -> ListingResponse[RelatedCluster]:
 
-    tag_t = tag_table.alias("t")
-    cluster_t = tag_table.alias("c")
+    member_t = tag_cluster_table.alias("t")
+    cluster_member_t = tag_cluster_table.alias("c")
+    related_t = cluster_table.alias("r")
 
-    articles = func.count(func.distinct(cluster_t.c.article))
+    articles = func.count(func.distinct(cluster_member_t.c.article))
     stmt = select(
-        tag_t.c.cluster.label("id"),
-        tag_t.c.cluster_label.label("label"),
-        tag_t.c.cluster_type.label("type"),
+        related_t.c.id,
+        related_t.c.label,
+        related_t.c.type,
         articles.label("articles"),
     )
-    stmt = stmt.where(tag_t.c.article == cluster_t.c.article)
-    stmt = stmt.where(tag_t.c.cluster != cluster)
-    stmt = stmt.where(cluster_t.c.cluster == cluster)
+    stmt = stmt.join_from(member_t, related_t, related_t.c.id == member_t.c.cluster)
+    stmt = stmt.where(member_t.c.article == cluster_member_t.c.article)
+    stmt = stmt.where(member_t.c.cluster != cluster)
+    stmt = stmt.where(cluster_member_t.c.cluster == cluster)
 
     if len(types):
-        stmt = stmt.where(tag_t.c.cluster_type.in_(types))
+        stmt = stmt.where(related_t.c.type.in_(types))
 
     link_fwd = link_table.alias("fwd")
     link_bck = link_table.alias("bck")
@@ -185,19 +200,19 @@ def list_related(
     stmt_bck = stmt_bck.filter(link_bck.c.target_cluster == cluster)
     cte = stmt_fwd.cte("links").union(stmt_bck)
     if linked is False:
-        stmt = stmt.where(tag_t.c.cluster.not_in(select(cte.c.cluster)))
+        stmt = stmt.where(member_t.c.cluster.not_in(select(cte.c.cluster)))
     else:
         link_types = func.array_remove(func.array_agg(func.distinct(cte.c.type)), None)
         stmt = stmt.add_columns(link_types.label("link_types"))
-        stmt = stmt.outerjoin(cte, cte.c.cluster == tag_t.c.cluster)
+        stmt = stmt.outerjoin(cte, cte.c.cluster == member_t.c.cluster)
         if linked is True:
             stmt = stmt.where(cte.c.type != None)
 
-    total = count_stmt(conn, stmt, func.distinct(tag_t.c.cluster))
+    total = count_stmt(conn, stmt, func.distinct(member_t.c.cluster))
     stmt = stmt.group_by(
-        tag_t.c.cluster,
-        tag_t.c.cluster_label,
-        tag_t.c.cluster_type,
+        related_t.c.id,
+        related_t.c.label,
+        related_t.c.type,
     )
     stmt = stmt.order_by(articles.desc())
     stmt = stmt.limit(listing.limit).offset(listing.offset)
@@ -219,16 +234,18 @@ def list_story_pairs(
     linked: Optional[bool] = None,
     types: List[str] = [],
 ) -> ListingResponse[ClusterPair]:
-    left_t = tag_table.alias("l")
-    right_t = tag_table.alias("r")
+    left_t = tag_cluster_table.alias("l")
+    right_t = tag_cluster_table.alias("r")
+    left_c = cluster_table.alias("lc")
+    right_c = cluster_table.alias("rc")
     articles = func.count(func.distinct(left_t.c.article))
     stmt = select(
-        left_t.c.cluster.label("left_id"),
-        left_t.c.cluster_type.label("left_type"),
-        left_t.c.cluster_label.label("left_label"),
-        right_t.c.cluster.label("right_id"),
-        right_t.c.cluster_type.label("right_type"),
-        right_t.c.cluster_label.label("right_label"),
+        left_c.c.id.label("left_id"),
+        left_c.c.type.label("left_type"),
+        left_c.c.label.label("left_label"),
+        right_c.c.id.label("right_id"),
+        right_c.c.type.label("right_type"),
+        right_c.c.label.label("right_label"),
         articles.label("articles"),
     )
     stmt = stmt.join_from(
@@ -238,10 +255,12 @@ def list_story_pairs(
             left_t.c.article == right_t.c.article, left_t.c.cluster > right_t.c.cluster
         ),
     )
+    stmt = stmt.join_from(left_t, left_c, left_c.c.id == left_t.c.cluster)
+    stmt = stmt.join_from(right_t, right_c, right_c.c.id == right_t.c.cluster)
 
     if len(types):
-        stmt = stmt.where(left_t.c.cluster_type.in_(types))
-        stmt = stmt.where(right_t.c.cluster_type.in_(types))
+        stmt = stmt.where(left_c.c.type.in_(types))
+        stmt = stmt.where(right_c.c.type.in_(types))
 
     sa_t = story_article_table.alias("sa")
     stmt = stmt.join_from(left_t, sa_t, left_t.c.article == sa_t.c.article)
@@ -269,12 +288,12 @@ def list_story_pairs(
 
     total = count_stmt(conn, stmt, left_t.c.cluster)
     stmt = stmt.group_by(
-        left_t.c.cluster,
-        left_t.c.cluster_label,
-        left_t.c.cluster_type,
-        right_t.c.cluster,
-        right_t.c.cluster_label,
-        right_t.c.cluster_type,
+        left_c.c.id,
+        left_c.c.label,
+        left_c.c.type,
+        right_c.c.id,
+        right_c.c.label,
+        right_c.c.type,
     )
     stmt = stmt.order_by(articles.desc())
     stmt = stmt.limit(listing.limit).offset(listing.offset)
@@ -339,108 +358,3 @@ def explode_cluster(conn: Conn, cluster: str) -> str:
     for ref in referents:
         update_cluster(conn, ref)
     return cluster
-
-
-def untag_article(conn: Conn, cluster: str, article: str) -> str:
-    sstmt = select(tag_table)
-    sstmt = sstmt.filter(tag_table.c.article == article)
-    sstmt = sstmt.filter(tag_table.c.cluster == cluster)
-    row = conn.execute(sstmt).fetchone()
-    if row is None:
-        return cluster
-    tag_id = row["id"]
-    if tag_id == cluster:
-        raise ValueError("This is the root article for the cluster")
-
-    # stmt = update(tag_table)
-    # stmt = stmt.values({"cluster": tag_id})
-    # stmt = stmt.where(tag_table.c.cluster == cluster)
-    # stmt = stmt.where(tag_table.c.article == article)
-    # print("STMT", stmt, tag_id, cluster, article)
-    # conn.execute(stmt)
-    clear_links(conn, tag_id, cluster)
-    update_cluster(conn, cluster)
-    update_cluster(conn, tag_id)
-    return cluster
-
-
-def update_cluster(conn: Conn, id: str) -> str:
-    referents = compute_cluster(conn, id)
-    cluster = max(referents)
-
-    sstmt = select(tag_table)
-    sstmt = sstmt.where(tag_table.c.id.in_(referents))
-    res = conn.execute(sstmt)
-    rows = res.fetchall()
-    cluster_label = most_common([r.label for r in rows])
-    cluster_type = most_common([r.type for r in rows])
-
-    stmt = update(tag_table)
-    stmt = stmt.where(tag_table.c.id.in_(referents))
-    # stmt = stmt.where(
-    #     or_(
-    #         tag_table.c.cluster != cluster,
-    #         tag_table.c.cluster_label != cluster_label,
-    #         tag_table.c.cluster_type != cluster_type,
-    #     )
-    # )
-    stmt = stmt.values(
-        cluster=cluster,
-        cluster_label=cluster_label,
-        cluster_type=cluster_type,
-    )
-    conn.execute(stmt)
-
-    stmt = update(link_table)
-    stmt = stmt.where(link_table.c.source.in_(referents))
-    stmt = stmt.where(link_table.c.source_cluster != cluster)
-    stmt = stmt.values(source_cluster=cluster)
-    conn.execute(stmt)
-
-    stmt = update(link_table)
-    stmt = stmt.where(link_table.c.target.in_(referents))
-    stmt = stmt.where(link_table.c.target_cluster != cluster)
-    stmt = stmt.values(target_cluster=cluster)
-    conn.execute(stmt)
-    return cluster
-
-
-def compute_cluster(conn: Conn, id: str) -> Set[str]:
-    link_t = link_table.alias("l")
-    target = link_t.c.target
-    source = link_t.c.source
-    # type_c = link_t.c.type
-    # init_clause = or_(source == id, target == id)
-    # stmt_t = stmt_t.where(init_clause, type_c == LinkType.SAME)
-    # cte = stmt_t.cte("connected", recursive=True)
-    # cte_alias = cte.alias("c")
-    # stmt_r = select(target.label("target"), source.label("source"))
-    # join_clause = or_(
-    #     cte_alias.c.source == source,
-    #     cte_alias.c.source == target,
-    #     cte_alias.c.target == source,
-    #     cte_alias.c.target == target,
-    # )
-    # stmt_r = stmt_r.join(cte_alias, join_clause)
-    # stmt_r = stmt_r.where(type_c == LinkType.SAME)
-    # cte = cte.union(stmt_r)  # type: ignore
-
-    # stmt = select(cte.c.source, cte.c.target)
-    # connected = set([id])
-    # for row in conn.execute(stmt).fetchall():
-    #     connected.add(row.source)
-    #     connected.add(row.target)
-    # return connected
-    connected = set([id])
-    fresh = set([id])
-    while len(fresh):
-        stmt = select(target.label("target"), source.label("source"))
-        stmt = stmt.filter(link_t.c.type == LinkType.SAME)
-        stmt = stmt.filter(or_(source.in_(fresh), target.in_(fresh)))
-        fresh = set()
-        for row in conn.execute(stmt):
-            for node in (row.source, row.target):
-                if node not in connected:
-                    fresh.add(node)
-                    connected.add(node)
-    return connected
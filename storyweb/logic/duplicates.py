@@ -0,0 +1,54 @@
+import logging
+from typing import Dict, Iterable, List, Set, Tuple
+from sqlalchemy.sql import select, delete, insert, tuple_
+
+from storyweb.db import Conn
+from storyweb.db import minhash_table, minhash_band_table
+
+log = logging.getLogger(__name__)
+
+
+def fetch_band_matches(
+    conn: Conn, keys: Set[Tuple[int, int]]
+) -> Dict[Tuple[int, int], List[str]]:
+    """Find the indexed articles which share any of the given LSH band buckets."""
+    matches: Dict[Tuple[int, int], List[str]] = {}
+    table = minhash_band_table
+    if not len(keys):
+        return matches
+    stmt = select(table.c.band, table.c.bucket, table.c.article)
+    stmt = stmt.where(tuple_(table.c.band, table.c.bucket).in_(list(keys)))
+    for row in conn.execute(stmt):
+        matches.setdefault((row.band, row.bucket), []).append(row.article)
+    return matches
+
+
+def fetch_signatures(conn: Conn, ids: Iterable[str]) -> Dict[str, bytes]:
+    signatures: Dict[str, bytes] = {}
+    stmt = select(minhash_table.c.article, minhash_table.c.signature)
+    stmt = stmt.where(minhash_table.c.article.in_(list(ids)))
+    for row in conn.execute(stmt):
+        signatures[row.article] = row.signature
+    return signatures
+
+
+def save_signatures(
+    conn: Conn,
+    ids: List[str],
+    signatures: Dict[str, bytes],
+    keys: Dict[str, List[Tuple[int, int]]],
+) -> None:
+    """Replace the index entries of the given articles. Only the articles which
+    have a signature are indexed again."""
+    for table in (minhash_table, minhash_band_table):
+        conn.execute(delete(table).where(table.c.article.in_(ids)))
+    if not len(signatures):
+        return
+    values = [{"article": a, "signature": s} for (a, s) in signatures.items()]
+    conn.execute(insert(minhash_table).values(values))
+    band_values = [
+        {"band": band, "bucket": bucket, "article": article}
+        for (article, article_keys) in keys.items()
+        for (band, bucket) in article_keys
+    ]
+    conn.execute(insert(minhash_band_table).values(band_values))
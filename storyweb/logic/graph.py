@@ -9,6 +9,7 @@ from sqlalchemy.engine import Row
 from networkx.readwrite.gexf import generate_gexf
 
 from storyweb.db import Conn, link_table, tag_table, story_article_table
+from storyweb.db import tag_cluster_table, cluster_table
 from storyweb.ontology import ontology, LinkType
 
 
@@ -18,39 +19,36 @@ def query_links(
     link_types: List[str] = list(ontology.link_types.keys()),
 ) -> Generator[Row, None, None]:
     link_t = link_table.alias("l")
+    source_c = cluster_table.alias("sc")
     source_t = tag_table.alias("s")
+    target_c = cluster_table.alias("tc")
     target_t = tag_table.alias("t")
 
     lstmt = select(
         link_t.c.type.label("link_type"),
-        source_t.c.cluster.label("source_id"),
+        source_c.c.id.label("source_id"),
         source_t.c.label.label("source_alias"),
-        source_t.c.cluster_label.label("source_label"),
-        source_t.c.cluster_type.label("source_type"),
-        target_t.c.cluster.label("target_id"),
+        source_c.c.label.label("source_label"),
+        source_c.c.type.label("source_type"),
+        target_c.c.id.label("target_id"),
         target_t.c.label.label("target_alias"),
-        target_t.c.cluster_label.label("target_label"),
-        target_t.c.cluster_type.label("target_type"),
+        target_c.c.label.label("target_label"),
+        target_c.c.type.label("target_type"),
     )
+    lstmt = lstmt.join(source_c, link_t.c.source_cluster == source_c.c.id)
+    lstmt = lstmt.join(source_t, link_t.c.source_cluster == source_t.c.id)
+    lstmt = lstmt.join(target_c, link_t.c.target_cluster == target_c.c.id)
+    lstmt = lstmt.join(target_t, link_t.c.target_cluster == target_t.c.id)
 
     if story_id is not None:
-        sa_source_t = story_article_table.alias("src_sa")
-        sa_target_t = story_article_table.alias("tgt_sa")
-        lstmt = lstmt.join(source_t, link_t.c.source_cluster == source_t.c.cluster)
-        lstmt = lstmt.join(sa_source_t, sa_source_t.c.article == source_t.c.article)
-        lstmt = lstmt.filter(sa_source_t.c.story == story_id)
-        lstmt = lstmt.join(target_t, link_t.c.target_cluster == target_t.c.cluster)
-        lstmt = lstmt.join(sa_target_t, sa_target_t.c.article == target_t.c.article)
-        lstmt = lstmt.filter(sa_target_t.c.story == story_id)
-        # lstmt = lstmt.filter(
-        #     or_(
-        #         sa_target_t.c.story == story,
-        #         sa_source_t.c.story == story,
-        #     )
-        # )
-    else:
-        lstmt = lstmt.join(source_t, link_t.c.source_cluster == source_t.c.id)
-        lstmt = lstmt.join(target_t, link_t.c.target_cluster == target_t.c.id)
+        # Both clusters must be mentioned in an article of the story:
+        for cluster_c in (source_c, target_c):
+            member_t = tag_cluster_table.alias()
+            sa_t = story_article_table.alias()
+            in_story = select(member_t.c.cluster)
+            in_story = in_story.join(sa_t, sa_t.c.article == member_t.c.article)
+            in_story = in_story.where(sa_t.c.story == story_id)
+            lstmt = lstmt.filter(cluster_c.c.id.in_(in_story))
 
     lstmt = lstmt.where(link_t.c.type.in_(link_types))
     lstmt = lstmt.distinct()
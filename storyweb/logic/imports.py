@@ -0,0 +1,114 @@
+import logging
+from datetime import datetime
+from typing import Dict, List, Optional, Tuple
+from sqlalchemy import MetaData, Table, Column, Integer, Unicode
+from sqlalchemy.sql import TableClause, select, delete, func
+
+from storyweb.db import Conn, upsert
+from storyweb.db import article_table, checkpoint_table, sync_cursor_table
+
+log = logging.getLogger(__name__)
+
+# The IDs of the articles in a source file along with their shard, which are
+# staged (see `create_stage`) to be counted in the database:
+shard_table = Table(
+    "shard",
+    MetaData(),
+    Column("shard", Integer),
+    Column("id", Unicode(255)),
+)
+
+
+def fetch_article_hashes(
+    conn: Conn, ids: List[str]
+) -> Dict[str, Tuple[Optional[str], Optional[str]]]:
+    """Get the content hash of each of the given articles which is stored, and
+    the ID of the article it was found to be a near-duplicate of, if any."""
+    stmt = select(
+        article_table.c.id,
+        article_table.c.hash,
+        article_table.c.duplicate_of,
+    )
+    stmt = stmt.where(article_table.c.id.in_(ids))
+    cursor = conn.execute(stmt)
+    return {r.id: (r.hash, r.duplicate_of) for r in cursor.fetchall()}
+
+
+def fetch_checkpoint(
+    conn: Conn, source: str
+) -> Tuple[int, Optional[int], Optional[int]]:
+    """Get the position up to which a source file has been imported, and the size
+    and modification time the file had then."""
+    stmt = select(
+        checkpoint_table.c.position,
+        checkpoint_table.c.size,
+        checkpoint_table.c.mtime,
+    )
+    stmt = stmt.where(checkpoint_table.c.source == source)
+    row = conn.execute(stmt).fetchone()
+    if row is None:
+        return (0, None, None)
+    return (row.position, row.size, row.mtime)
+
+
+def save_checkpoint(
+    conn: Conn, source: str, position: int, size: int, mtime: int
+) -> None:
+    values = dict(
+        source=source,
+        position=position,
+        size=size,
+        mtime=mtime,
+        updated_at=datetime.utcnow(),
+    )
+    istmt = upsert(checkpoint_table).values([values])
+    updates = dict(
+        position=istmt.excluded.position,
+        size=istmt.excluded.size,
+        mtime=istmt.excluded.mtime,
+        updated_at=istmt.excluded.updated_at,
+    )
+    stmt = istmt.on_conflict_do_update(index_elements=["source"], set_=updates)
+    conn.execute(stmt)
+
+
+def clear_checkpoint(conn: Conn, source: str) -> None:
+    stmt = delete(checkpoint_table)
+    stmt = stmt.where(checkpoint_table.c.source == source)
+    conn.execute(stmt)
+
+
+def fetch_sync_cursor(conn: Conn, source: str) -> Optional[datetime]:
+    stmt = select(sync_cursor_table.c.modified_after)
+    stmt = stmt.where(sync_cursor_table.c.source == source)
+    return conn.execute(stmt).scalar()
+
+
+def save_sync_cursor(conn: Conn, source: str, modified_after: datetime) -> None:
+    values = dict(
+        source=source,
+        modified_after=modified_after,
+        updated_at=datetime.utcnow(),
+    )
+    istmt = upsert(sync_cursor_table).values([values])
+    updates = dict(
+        modified_after=istmt.excluded.modified_after,
+        updated_at=istmt.excluded.updated_at,
+    )
+    stmt = istmt.on_conflict_do_update(index_elements=["source"], set_=updates)
+    conn.execute(stmt)
+
+
+def count_shards(conn: Conn, stage: TableClause) -> Dict[int, Tuple[int, int]]:
+    """Count the distinct articles of each shard in the stage, and how many of
+    them are in the database."""
+    stmt = select(
+        stage.c.shard,
+        func.count(func.distinct(stage.c.id)),
+        func.count(func.distinct(article_table.c.id)),
+    )
+    stmt = stmt.select_from(
+        stage.outerjoin(article_table, article_table.c.id == stage.c.id)
+    )
+    stmt = stmt.group_by(stage.c.shard)
+    return {r[0]: (r[1], r[2]) for r in conn.execute(stmt)}
@@ -1,17 +1,24 @@
 import logging
 from datetime import datetime
-from typing import List, Set, Dict, Tuple
-from sqlalchemy.sql import select, delete, update, and_, or_, func
+from collections import Counter
+from typing import Collection, Iterable, List, Set, Dict, Tuple, Union
+from sqlalchemy import Unicode
+from sqlalchemy.sql import Select, select, delete, update, and_, or_, func, case, cast
+from sqlalchemy.dialects.postgresql import array
 
-from storyweb.db import Conn, upsert, engine
-from storyweb.db import tag_table, link_table, story_article_table
-from storyweb.clean import most_common
+from storyweb.db import Conn, upsert, engine, KEY_LEN
+from storyweb.db import tag_table, tag_cluster_table, cluster_table
+from storyweb.db import cluster_type_table
+from storyweb.db import link_table, story_article_table
 from storyweb.logic.util import count_stmt
 from storyweb.models import Link, Listing, ListingResponse
 from storyweb.ontology import LinkType
 
 log = logging.getLogger(__name__)
 
+# The key space of the advisory locks which are taken on cluster IDs:
+CLUSTER_LOCK = 1
+
 
 def list_links(
     conn: Conn, listing: Listing, clusters: List[str]
@@ -85,13 +92,13 @@ def create_link(conn: Conn, source: str, target: str, type: str) -> Link:
 
 
 def untag_article(conn: Conn, cluster: str, article: str) -> str:
-    sstmt = select(tag_table)
-    sstmt = sstmt.filter(tag_table.c.article == article)
-    sstmt = sstmt.filter(tag_table.c.cluster == cluster)
+    sstmt = select(tag_cluster_table)
+    sstmt = sstmt.filter(tag_cluster_table.c.article == article)
+    sstmt = sstmt.filter(tag_cluster_table.c.cluster == cluster)
     row = conn.execute(sstmt).fetchone()
     if row is None:
         return cluster
-    tag_id = row["id"]
+    tag_id = row["tag"]
     if tag_id == cluster:
         raise ValueError("This is the root article for the cluster")
 
@@ -118,32 +125,104 @@ def save_links(conn: Conn, links: List[Link]) -> None:
     conn.execute(stmt)
 
 
+def count_cluster_types(
+    conn: Conn, added: Iterable[str], removed: Iterable[str] = []
+) -> None:
+    """Update the number of clusters per type, given the types of the clusters
+    which were added and removed (or changed their type)."""
+    deltas: Counter[str] = Counter(added)
+    deltas.subtract(removed)
+    # Sorted, so that concurrent imports lock the rows in the same order:
+    rows = [dict(type=t, clusters=d) for t, d in sorted(deltas.items()) if d != 0]
+    if not len(rows):
+        return
+    istmt = upsert(cluster_type_table).values(rows)
+    clusters = cluster_type_table.c.clusters + istmt.excluded.clusters
+    istmt = istmt.on_conflict_do_update(
+        index_elements=["type"], set_=dict(clusters=clusters)
+    )
+    conn.execute(istmt)
+
+
+def lock_clusters(conn: Conn, ids: Union[Collection[str], Select]) -> None:
+    """Lock the given cluster IDs until the end of the transaction. Row locks
+    would not do, since a refresh can also create the cluster. The IDs are
+    locked in order, so that concurrent imports do not deadlock."""
+    if not isinstance(ids, Select):
+        values = array(sorted(set(ids)), type_=Unicode)
+        ids = select(func.unnest(values).column_valued("id"))
+    keys = ids.subquery()
+    key = list(keys.columns)[0]
+    ordered = select(key).distinct().order_by(key).subquery()
+    key = list(ordered.columns)[0]
+    lock = func.pg_advisory_xact_lock(CLUSTER_LOCK, func.hashtext(key))
+    conn.execute(select(lock).select_from(ordered))
+
+
+def refresh_clusters(conn: Conn, ids: Union[Collection[str], Select]) -> None:
+    """Recompute the label, type and statistics of the given clusters from their
+    member tags, and remove the clusters which no longer have any members. The
+    most frequent label and type among the tags win."""
+    if not isinstance(ids, Select) and not len(ids):
+        return
+    # The types are read under the lock, or the deltas applied to the number of
+    # clusters per type would race with those of other refreshes:
+    lock_clusters(conn, ids)
+    pstmt = select(cluster_table.c.type).where(cluster_table.c.id.in_(ids))
+    previous = conn.execute(pstmt).scalars().all()
+
+    member_t = tag_cluster_table.alias("m")
+    tag_t = tag_table.alias("t")
+    stmt = select(
+        member_t.c.cluster,
+        func.mode().within_group(tag_t.c.type),
+        func.mode().within_group(tag_t.c.label),
+        func.count(func.distinct(member_t.c.article)),
+        func.array_agg(func.distinct(tag_t.c.label)),
+        func.coalesce(func.sum(tag_t.c.count), 0),
+        func.array_to_string(func.array_agg(func.distinct(tag_t.c.label)), "\n"),
+    )
+    stmt = stmt.join(tag_t, tag_t.c.id == member_t.c.tag)
+    stmt = stmt.where(member_t.c.cluster.in_(ids))
+    stmt = stmt.group_by(member_t.c.cluster)
+    columns = [c.name for c in cluster_table.columns]
+    istmt = upsert(cluster_table).from_select(columns, stmt)
+    values = dict(
+        type=istmt.excluded.type,
+        label=istmt.excluded.label,
+        articles=istmt.excluded.articles,
+        labels=istmt.excluded.labels,
+        mentions=istmt.excluded.mentions,
+        search=istmt.excluded.search,
+    )
+    istmt = istmt.on_conflict_do_update(index_elements=["id"], set_=values)
+    istmt = istmt.returning(cluster_table.c.type)
+    current = conn.execute(istmt).scalars().all()
+
+    members = select(tag_cluster_table.c.cluster)
+    members = members.where(tag_cluster_table.c.cluster == cluster_table.c.id)
+    dstmt = delete(cluster_table).where(cluster_table.c.id.in_(ids))
+    dstmt = dstmt.where(~members.exists())
+    conn.execute(dstmt)
+    count_cluster_types(conn, current, previous)
+
+
 def update_cluster(conn: Conn, id: str) -> str:
     referents = compute_cluster(conn, id)
     cluster = max(referents)
 
-    sstmt = select(tag_table)
-    sstmt = sstmt.where(tag_table.c.id.in_(referents))
-    res = conn.execute(sstmt)
-    rows = res.fetchall()
-    cluster_label = most_common([r.label for r in rows])
-    cluster_type = most_common([r.type for r in rows])
-
-    stmt = update(tag_table)
-    stmt = stmt.where(tag_table.c.id.in_(referents))
-    # stmt = stmt.where(
-    #     or_(
-    #         tag_table.c.cluster != cluster,
-    #         tag_table.c.cluster_label != cluster_label,
-    #         tag_table.c.cluster_type != cluster_type,
-    #     )
-    # )
-    stmt = stmt.values(
-        cluster=cluster,
-        cluster_label=cluster_label,
-        cluster_type=cluster_type,
-    )
+    # Clusters which lose members have to be updated as well:
+    sstmt = select(func.distinct(tag_cluster_table.c.cluster))
+    sstmt = sstmt.where(tag_cluster_table.c.tag.in_(referents))
+    affected = set(conn.execute(sstmt).scalars())
+    affected.add(cluster)
+
+    stmt = update(tag_cluster_table)
+    stmt = stmt.where(tag_cluster_table.c.tag.in_(referents))
+    stmt = stmt.where(tag_cluster_table.c.cluster != cluster)
+    stmt = stmt.values(cluster=cluster)
     conn.execute(stmt)
+    refresh_clusters(conn, affected)
 
     stmt = update(link_table)
     stmt = stmt.where(link_table.c.source.in_(referents))
@@ -160,51 +239,32 @@ def update_cluster(conn: Conn, id: str) -> str:
 
 
 def compute_cluster(conn: Conn, id: str) -> Set[str]:
+    """Find all tags which are connected to the given one by SAME links, in
+    either direction, including the tag itself. The whole component is resolved
+    in one recursive query; UNION (rather than UNION ALL) discards the nodes which
+    have already been seen, so that cycles end the recursion."""
+    seed = select(cast(id, Unicode(KEY_LEN)).label("node"))
+    connected = seed.cte("connected", recursive=True)
+    node = connected.alias("c").c.node
     link_t = link_table.alias("l")
-    target = link_t.c.target
-    source = link_t.c.source
-    # type_c = link_t.c.type
-    # init_clause = or_(source == id, target == id)
-    # stmt_t = stmt_t.where(init_clause, type_c == LinkType.SAME)
-    # cte = stmt_t.cte("connected", recursive=True)
-    # cte_alias = cte.alias("c")
-    # stmt_r = select(target.label("target"), source.label("source"))
-    # join_clause = or_(
-    #     cte_alias.c.source == source,
-    #     cte_alias.c.source == target,
-    #     cte_alias.c.target == source,
-    #     cte_alias.c.target == target,
-    # )
-    # stmt_r = stmt_r.join(cte_alias, join_clause)
-    # stmt_r = stmt_r.where(type_c == LinkType.SAME)
-    # cte = cte.union(stmt_r)  # type: ignore
-
-    # stmt = select(cte.c.source, cte.c.target)
-    # connected = set([id])
-    # for row in conn.execute(stmt).fetchall():
-    #     connected.add(row.source)
-    #     connected.add(row.target)
-    # return connected
-    connected = set([id])
-    fresh = set([id])
-    while len(fresh):
-        stmt = select(target.label("target"), source.label("source"))
-        stmt = stmt.filter(link_t.c.type == LinkType.SAME)
-        stmt = stmt.filter(or_(source.in_(fresh), target.in_(fresh)))
-        fresh = set()
-        for row in conn.execute(stmt):
-            for node in (row.source, row.target):
-                if node not in connected:
-                    fresh.add(node)
-                    connected.add(node)
-    return connected
+    neighbour = case(
+        (link_t.c.source == node, link_t.c.target),
+        else_=link_t.c.source,
+    )
+    step = select(neighbour.label("node"))
+    step = step.where(or_(link_t.c.source == node, link_t.c.target == node))
+    step = step.where(link_t.c.type == LinkType.SAME)
+    connected = connected.union(step)
+    stmt = select(connected.c.node)
+    return set([id] + [row.node for row in conn.execute(stmt)])
 
 
 def auto_merge(conn: Conn, check_links: bool = True):
     stmt = select(
         tag_table.c.fingerprint.label("fingerprint"),
-        func.array_agg(tag_table.c.cluster).label("clusters"),
+        func.array_agg(tag_cluster_table.c.cluster).label("clusters"),
     )
+    stmt = stmt.join(tag_cluster_table, tag_cluster_table.c.tag == tag_table.c.id)
     stmt = stmt.group_by(tag_table.c.fingerprint)
     stmt = stmt.order_by(func.count(tag_table.c.id).desc())
     stmt = stmt.having(func.count(tag_table.c.id) > 1)
@@ -254,21 +314,26 @@ def auto_merge(conn: Conn, check_links: bool = True):
 
 def story_merge(conn: Conn, story: int, article: str) -> None:
     inner_t = tag_table.alias("tag_inner")
+    inner_c = tag_cluster_table.alias("cluster_inner")
     outer_t = tag_table.alias("tag_outer")
+    outer_c = tag_cluster_table.alias("cluster_outer")
     sat_t = story_article_table.alias("sat")
     stmt = select(
-        inner_t.c.cluster.label("tag"),
-        outer_t.c.cluster.label("cluster"),
-        func.count(outer_t.c.article).label("articles"),
+        inner_c.c.cluster.label("tag"),
+        outer_c.c.cluster.label("cluster"),
+        func.count(outer_c.c.article).label("articles"),
     )
-    stmt = stmt.filter(inner_t.c.article == article)
-    stmt = stmt.filter(inner_t.c.id == inner_t.c.cluster)
+    stmt = stmt.select_from(inner_c)
+    stmt = stmt.filter(inner_c.c.article == article)
+    stmt = stmt.filter(inner_c.c.tag == inner_c.c.cluster)
+    stmt = stmt.join(inner_t, inner_t.c.id == inner_c.c.tag)
     stmt = stmt.join(outer_t, outer_t.c.fingerprint == inner_t.c.fingerprint)
-    stmt = stmt.join(sat_t, outer_t.c.article == sat_t.c.article)
+    stmt = stmt.join(outer_c, outer_c.c.tag == outer_t.c.id)
+    stmt = stmt.join(sat_t, outer_c.c.article == sat_t.c.article)
     stmt = stmt.filter(sat_t.c.story == story)
-    stmt = stmt.filter(inner_t.c.cluster != outer_t.c.cluster)
-    stmt = stmt.group_by(inner_t.c.cluster, outer_t.c.cluster)
-    stmt = stmt.order_by(func.count(outer_t.c.article).desc())
+    stmt = stmt.filter(inner_c.c.cluster != outer_c.c.cluster)
+    stmt = stmt.group_by(inner_c.c.cluster, outer_c.c.cluster)
+    stmt = stmt.order_by(func.count(outer_c.c.article).desc())
     cursor = conn.execute(stmt)
     now = datetime.utcnow()
 
@@ -0,0 +1,210 @@
+import logging
+from datetime import datetime
+from typing import Any, Dict, Generator, List, Optional, Set, Tuple
+from sqlalchemy.sql import Select, select, update
+
+from storyweb.db import Conn, upsert
+from storyweb.db import tag_table, tag_cluster_table, cluster_table, link_table
+from storyweb.logic.links import refresh_clusters
+from storyweb.logic.util import copy_rows, create_stage
+from storyweb.ontology import LinkType
+
+log = logging.getLogger(__name__)
+
+FETCH_SIZE = 10000
+
+
+class UnionFind(object):
+    """Disjoint sets over the integers 0..n-1, with union by size and path
+    halving. Sets can be kept apart: a union which would bring together two
+    members that must not be merged is refused."""
+
+    def __init__(self) -> None:
+        self.parent: List[int] = []
+        self.size: List[int] = []
+        self.apart: Dict[int, Set[int]] = {}
+
+    def add(self) -> int:
+        node = len(self.parent)
+        self.parent.append(node)
+        self.size.append(1)
+        return node
+
+    def find(self, node: int) -> int:
+        parent = self.parent
+        while parent[node] != node:
+            parent[node] = parent[parent[node]]
+            node = parent[node]
+        return node
+
+    def keep_apart(self, left: int, right: int) -> bool:
+        """Record that two members must never end up in the same set. Returns
+        `False` if they already are."""
+        left_root, right_root = self.find(left), self.find(right)
+        if left_root == right_root:
+            return False
+        self.apart.setdefault(left_root, set()).add(right)
+        self.apart.setdefault(right_root, set()).add(left)
+        return True
+
+    def _conflict(self, left_root: int, right_root: int) -> bool:
+        left = self.apart.get(left_root, set())
+        right = self.apart.get(right_root, set())
+        if len(left) > len(right):
+            left, right_root = right, left_root
+        return any(self.find(node) == right_root for node in left)
+
+    def union(self, left: int, right: int, check: bool = True) -> bool:
+        """Merge the sets of two members. Returns `True` if two separate sets
+        were merged."""
+        left_root, right_root = self.find(left), self.find(right)
+        if left_root == right_root:
+            return False
+        if check and self._conflict(left_root, right_root):
+            return False
+        if self.size[left_root] < self.size[right_root]:
+            left_root, right_root = right_root, left_root
+        self.parent[right_root] = left_root
+        self.size[left_root] += self.size[right_root]
+        right_apart = self.apart.pop(right_root, None)
+        if right_apart is not None:
+            self.apart.setdefault(left_root, set()).update(right_apart)
+        return True
+
+
+def _stream(conn: Conn, stmt: Select) -> Generator[Any, None, None]:
+    cursor = conn.execution_options(stream_results=True).execute(stmt)
+    while True:
+        rows = cursor.fetchmany(FETCH_SIZE)
+        if not rows:
+            break
+        yield from rows
+
+
+def auto_merge_bulk(conn: Conn, check_links: bool = True) -> int:
+    """Merge the tags which share a fingerprint across the whole corpus. All tags
+    and links are read once and the clusters are computed in memory, before the
+    results are written back in a few set-based statements. Existing SAME links
+    are kept, and unless `check_links` is disabled, tags which are connected by
+    any other type of link are never merged into one cluster. Returns the number
+    of links that were created."""
+    sets = UnionFind()
+    ids: List[str] = []
+    index: Dict[str, int] = {}
+    articles: List[str] = []
+    current: List[str] = []
+    groups: List[Tuple[int, int]] = []
+
+    stmt = select(
+        tag_table.c.id,
+        tag_table.c.fingerprint,
+        tag_cluster_table.c.article,
+        tag_cluster_table.c.cluster,
+    )
+    stmt = stmt.join(tag_cluster_table, tag_cluster_table.c.tag == tag_table.c.id)
+    stmt = stmt.order_by(tag_table.c.fingerprint, tag_table.c.id)
+    fingerprint: Optional[str] = None
+    for row in _stream(conn, stmt):
+        node = sets.add()
+        ids.append(row.id)
+        index[row.id] = node
+        articles.append(row.article)
+        current.append(row.cluster)
+        if row.fingerprint != fingerprint or not len(groups):
+            groups.append((node, node))
+        groups[-1] = (groups[-1][0], node)
+        fingerprint = row.fingerprint
+    log.info("Loaded %d tags, %d fingerprints", len(ids), len(groups))
+
+    apart: List[Tuple[int, int]] = []
+    stmt = select(link_table.c.source, link_table.c.target, link_table.c.type)
+    for row in _stream(conn, stmt):
+        source, target = index.get(row.source), index.get(row.target)
+        if source is None or target is None:
+            continue
+        if row.type == LinkType.SAME:
+            sets.union(source, target, check=False)
+        elif check_links:
+            apart.append((source, target))
+    for source, target in apart:
+        if not sets.keep_apart(source, target):
+            log.warning(
+                "Linked tags are in the same cluster: %s, %s", ids[source], ids[target]
+            )
+
+    created: List[Tuple[int, int]] = []
+    for first, last in groups:
+        for node in range(first + 1, last + 1):
+            if sets.union(node, first):
+                created.append((node, first))
+    log.info("Merging with %d new links", len(created))
+
+    # Clusters are named after their greatest tag ID:
+    clusters: Dict[int, str] = {}
+    for node in range(len(ids)):
+        root = sets.find(node)
+        if root not in clusters or ids[node] > clusters[root]:
+            clusters[root] = ids[node]
+
+    # Only the tags which move to another cluster are written back, and the
+    # clusters they leave or join are refreshed:
+    moved: List[List[Any]] = []
+    affected: Set[str] = set()
+    for node in range(len(ids)):
+        cluster = clusters[sets.find(node)]
+        if cluster != current[node]:
+            moved.append([ids[node], cluster, articles[node]])
+            affected.update((cluster, current[node]))
+
+    member_stage, cluster_stage, link_stage = create_stage(
+        conn, tag_cluster_table, cluster_table, link_table
+    )
+    copy_rows(conn, member_stage, moved)
+    stmt = update(tag_cluster_table)
+    stmt = stmt.where(tag_cluster_table.c.tag == member_stage.c.tag)
+    stmt = stmt.values(cluster=member_stage.c.cluster)
+    conn.execute(stmt)
+    log.info("Moved %d tags to other clusters", len(moved))
+    empty = [None] * (len(cluster_table.columns) - 1)
+    copy_rows(conn, cluster_stage, ([c, *empty] for c in affected))
+    refresh_clusters(conn, select(cluster_stage.c.id))
+
+    now = datetime.utcnow()
+    link_rows: List[List[Any]] = []
+    for source, target in created:
+        # Both ends of a new link are in the same cluster:
+        cluster = clusters[sets.find(source)]
+        link = dict(
+            source=ids[source],
+            source_cluster=cluster,
+            target=ids[target],
+            target_cluster=cluster,
+            type=LinkType.SAME,
+            user="auto-merge",
+            timestamp=now,
+        )
+        link_rows.append([link.get(c.name) for c in link_table.columns])
+    copy_rows(conn, link_stage, link_rows)
+    columns = [c.name for c in link_table.columns]
+    istmt = upsert(link_table).from_select(columns, select(link_stage))
+    values = dict(
+        type=istmt.excluded.type,
+        user=istmt.excluded.user,
+        timestamp=istmt.excluded.timestamp,
+    )
+    conn.execute(
+        istmt.on_conflict_do_update(index_elements=["source", "target"], set_=values)
+    )
+
+    # Point the links, old and new, at the clusters of the tags they connect:
+    for tag_col, cluster_col in (
+        (link_table.c.source, "source_cluster"),
+        (link_table.c.target, "target_cluster"),
+    ):
+        member = tag_cluster_table.c
+        stmt = update(link_table)
+        stmt = stmt.where(tag_col == member.tag)
+        stmt = stmt.where(link_table.c[cluster_col].is_distinct_from(member.cluster))
+        stmt = stmt.values({cluster_col: member.cluster})
+        conn.execute(stmt)
+    return len(created)
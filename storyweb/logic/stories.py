@@ -5,7 +5,7 @@ from sqlalchemy.sql import select, delete, update, insert, func
 from storyweb.db import Conn
 from storyweb.db import story_table
 from storyweb.db import story_article_table
-from storyweb.logic.util import count_stmt
+from storyweb.logic.util import count_stmt, search_filter, search_rank
 from storyweb.models import Story, StoryMutation, Listing, ListingResponse
 
 log = logging.getLogger(__name__)
@@ -16,7 +16,7 @@ def list_stories(
 ) -> ListingResponse[Story]:
     stmt = select(story_table)
     if query is not None and len(query.strip()):
-        stmt = stmt.where(story_table.c.title.ilike(f"%{query}%"))
+        stmt = stmt.where(search_filter(story_table.c.title, query))
     if article is not None and len(article.strip()):
         stmt = stmt.join(
             story_article_table,
@@ -24,6 +24,9 @@ def list_stories(
         )
         stmt = stmt.where(story_article_table.c.article == article)
     total = count_stmt(conn, stmt, story_table.c.id)
+    if query is not None and len(query.strip()):
+        stmt = stmt.order_by(search_rank(story_table.c.title, query))
+    stmt = stmt.order_by(story_table.c.id)
     stmt = stmt.limit(listing.limit).offset(listing.offset)
     cursor = conn.execute(stmt)
     results = [Story.parse_obj(r) for r in cursor.fetchall()]
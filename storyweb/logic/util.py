@@ -1,8 +1,11 @@
+import io
 import logging
-from sqlalchemy.sql import Select, Selectable, ColumnElement
-from sqlalchemy.sql import func
+from typing import Any, Iterable, List, Sequence
+from sqlalchemy import Table
+from sqlalchemy.sql import Select, Selectable, ColumnElement, TableClause
+from sqlalchemy.sql import func, text, table, column, case, or_
 
-from storyweb.db import Conn
+from storyweb.db import Conn, meta
 
 log = logging.getLogger(__name__)
 
@@ -11,3 +14,80 @@ def count_stmt(conn: Conn, stmt: Select, col: Selectable | ColumnElement) -> int
     count_stmt = stmt.with_only_columns(func.count(col))
     cursor = conn.execute(count_stmt)
     return cursor.scalar_one()
+
+
+def _escape_like(query: str) -> str:
+    for char in ("\\", "%", "_"):
+        query = query.replace(char, f"\\{char}")
+    return query
+
+
+def search_filter(col: ColumnElement, query: str) -> ColumnElement:
+    """Match the query anywhere in a text column, ignoring case. With the
+    `pg_trgm` extension installed, this is served by a trigram index."""
+    return col.ilike(f"%{_escape_like(query.strip())}%")
+
+
+def search_rank(col: ColumnElement, query: str) -> ColumnElement:
+    """Rank the matches of `search_filter`: texts (or the lines of texts) which
+    start with the query come first, then those with a word that starts with
+    it, then all others. Lower is better."""
+    query = _escape_like(query.strip())
+    return case(
+        (or_(col.ilike(f"{query}%"), col.ilike(f"%\n{query}%")), 0),
+        (col.ilike(f"% {query}%"), 1),
+        else_=2,
+    )
+
+
+def _copy_value(value: Any) -> str:
+    if value is None:
+        return "\\N"
+    value = str(value)
+    value = value.replace("\\", "\\\\")
+    value = value.replace("\t", "\\t")
+    value = value.replace("\n", "\\n")
+    return value.replace("\r", "\\r")
+
+
+def copy_rows(conn: Conn, target: TableClause, rows: Iterable[Sequence[Any]]) -> int:
+    """Bulk load rows into the given table using PostgreSQL `COPY`. The values
+    in each row must be in the order of the table's columns."""
+    buffer = io.StringIO()
+    count = 0
+    for row in rows:
+        buffer.write("\t".join(_copy_value(v) for v in row))
+        buffer.write("\n")
+        count += 1
+    if count == 0:
+        return count
+    buffer.seek(0)
+    columns = ", ".join(f'"{c.name}"' for c in target.columns)
+    cursor = conn.connection.cursor()
+    try:
+        cursor.copy_expert(f"COPY {target.name} ({columns}) FROM STDIN", buffer)
+    finally:
+        cursor.close()
+    return count
+
+
+def create_stage(conn: Conn, *tables: Table) -> Sequence[TableClause]:
+    """Create a temporary staging copy of each of the given tables, which is
+    dropped when the transaction is committed. Tables which are not part of the
+    database schema are created from their column definitions."""
+    stages: List[TableClause] = []
+    ddl: List[str] = []
+    for source in tables:
+        name = f"stage_{source.name}"
+        ddl.append(f"DROP TABLE IF EXISTS {name}")
+        if source.metadata is meta:
+            spec = f"LIKE {source.name} INCLUDING DEFAULTS"
+        else:
+            spec = ", ".join(
+                f'"{c.name}" {c.type.compile(dialect=conn.dialect)}'
+                for c in source.columns
+            )
+        ddl.append(f"CREATE TEMPORARY TABLE {name} ({spec}) ON COMMIT DROP")
+        stages.append(table(name, *[column(c.name) for c in source.columns]))
+    conn.execute(text("; ".join(ddl)))
+    return stages
@@ -5,6 +5,10 @@ from pydantic.generics import GenericModel
 
 R = TypeVar("R", bound=BaseModel)
 
+# Imports by URL through the API run within the request, so only a handful of
+# pages can be fetched at once. Larger lists go through `storyweb import-urls`.
+MAX_IMPORT_URLS = 20
+
 
 class Response(GenericModel):
     status: str = Field("ok")
@@ -37,6 +41,8 @@ class Article(BaseModel):
 
 class ArticleDetails(Article):
     text: str
+    hash: Optional[str]
+    duplicate_of: Optional[str]
 
 
 class StoryMutation(BaseModel):
@@ -48,10 +54,22 @@ class StoryArticleToggle(BaseModel):
     article: str
 
 
+class Source(BaseModel):
+    name: str
+    url: str
+    region: Optional[str]
+    country: Optional[str]
+    wp_api: Optional[str]
+
+
 class StoryArticleImportUrl(BaseModel):
     url: str
 
 
+class StoryArticleImportUrls(BaseModel):
+    urls: List[str] = Field(min_items=1, max_items=MAX_IMPORT_URLS)
+
+
 class Story(BaseModel):
     id: int
     title: str
@@ -61,7 +79,9 @@ class Story(BaseModel):
 class Sentence(BaseModel):
     article: str
     sequence: int
-    text: str
+    start_char: int
+    end_char: int
+    text: Optional[str] = None
 
 
 class ClusterBase(BaseModel):
@@ -71,13 +91,10 @@ class ClusterBase(BaseModel):
 
 
 class Tag(ClusterBase):
-    cluster: str
     article: str
     fingerprint: str
     count: int
     frequency: float
-    cluster_type: Optional[str]
-    cluster_label: Optional[str]
 
 
 class TagSentence(BaseModel):
@@ -86,8 +103,30 @@ class TagSentence(BaseModel):
     sentence: int
 
 
+class Mention(BaseModel):
+    article: str
+    tag: str
+    start_char: int
+    end_char: int
+
+
+class ArticleMention(Mention):
+    cluster: str
+    cluster_type: Optional[str]
+    cluster_label: Optional[str]
+
+
+class ExtractedArticle(BaseModel):
+    article: ArticleDetails
+    sentences: List[Sentence]
+    tag_sentences: List[TagSentence]
+    tags: List[Tag]
+    mentions: List[Mention]
+
+
 class Cluster(ClusterBase):
     articles: int
+    mentions: int
 
 
 class ClusterDetails(Cluster):
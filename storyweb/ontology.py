@@ -3,7 +3,7 @@ from pydantic import BaseModel
 from pydantic_yaml import YamlModel
 from typing import List, Optional
 
-from storyweb.clean import most_common
+from storyweb.clean import Names, most_common
 
 
 class ClusterTypeModel(BaseModel):
@@ -61,7 +61,7 @@ class ClusterType(object):
             return False
         return parent.is_a(name)
 
-    def pick(self, names: List[str]) -> str:
+    def pick(self, names: Names) -> str:
         """Given a set of categories, pick the most descriptive one."""
         # TODO: does this want to be a proper class-based type system (ftm?) at
         # some point?
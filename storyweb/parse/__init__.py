@@ -1,26 +1,51 @@
 import logging
-import requests
-from typing import Optional
+from typing import Iterable, List, Optional
 from articledata import URL
 
 from storyweb.db import Conn
-from storyweb.parse.extract import extract
-from storyweb.parse.pipeline import load_one_article
+from storyweb.parse.extract import extract, extract_pages
+from storyweb.parse.fetch import fetch_page, fetch_pages, THREADS
+from storyweb.parse.pipeline import load_one_article, import_articles
 
 log = logging.getLogger(__name__)
 
+# Pages are fetched (or extracted) by a pool of threads, and the worker processes
+# must not be forked while those are running:
+MP_CONTEXT = "spawn"
+
 
 def import_article_by_url(conn: Conn, url: str) -> Optional[str]:
-    try:
-        res = requests.get(url)
-        res.raise_for_status()
-    except Exception as exc:
-        log.exception("Cannot fetch article text: %r" % exc)
+    content = fetch_page(url)
+    if content is None:
         return None
 
     url_obj = URL(url)
-    article = extract(url_obj, res.content)
+    article = extract(url_obj, content)
     if article is None:
         return None
 
     return load_one_article(conn, article)
+
+
+def import_articles_by_url(
+    urls: Iterable[str],
+    workers: int = 1,
+    threads: int = THREADS,
+    force: bool = False,
+    dedupe: bool = True,
+) -> List[str]:
+    """Fetch, extract and tag many articles: pages are downloaded concurrently,
+    the text extraction and NER run in `workers` processes, and the results are
+    stored in batches. Returns the IDs of the imported articles. Turn off
+    `dedupe` when the articles are added to a story, which needs their tags even
+    if they are near-duplicates."""
+    pages = fetch_pages(urls, threads=threads)
+    fetched = ((url, content) for (url, content) in pages if content is not None)
+    articles = extract_pages(fetched, workers=workers, context=MP_CONTEXT)
+    return import_articles(
+        articles,
+        workers=workers,
+        force=force,
+        dedupe=dedupe,
+        context=MP_CONTEXT,
+    )
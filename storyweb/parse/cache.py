@@ -0,0 +1,58 @@
+import os
+import sqlite3
+import logging
+from pathlib import Path
+from functools import cache
+from typing import Dict, Iterable, Optional
+
+from storyweb import settings
+from storyweb.parse.util import chunked
+
+log = logging.getLogger(__name__)
+
+
+class AnnotationCache(object):
+    """An on-disk store of serialised spaCy annotations, keyed by a hash of the
+    model and the text. This is a plain SQLite file, so that it can be shared by
+    the worker processes of an import."""
+
+    def __init__(self, path: Path):
+        path.parent.mkdir(parents=True, exist_ok=True)
+        self.path = path
+        self.db = sqlite3.connect(path.as_posix(), timeout=60)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute(
+            "CREATE TABLE IF NOT EXISTS annotation "
+            "(key TEXT PRIMARY KEY, data BLOB NOT NULL)"
+        )
+        self.db.commit()
+
+    def get_many(self, keys: Iterable[str]) -> Dict[str, bytes]:
+        found: Dict[str, bytes] = {}
+        for chunk in chunked(keys, 500):
+            params = ", ".join("?" for _ in chunk)
+            query = f"SELECT key, data FROM annotation WHERE key IN ({params})"
+            for (key, data) in self.db.execute(query, chunk):
+                found[key] = data
+        return found
+
+    def put_many(self, items: Dict[str, bytes]) -> None:
+        if not len(items):
+            return
+        query = "INSERT OR REPLACE INTO annotation (key, data) VALUES (?, ?)"
+        self.db.executemany(query, items.items())
+        self.db.commit()
+
+
+@cache
+def _open_cache(pid: int) -> Optional[AnnotationCache]:
+    if settings.NLP_CACHE is None:
+        return None
+    path = Path(settings.NLP_CACHE)
+    log.info("Using NER annotation cache: %s", path)
+    return AnnotationCache(path)
+
+
+def get_annotation_cache() -> Optional[AnnotationCache]:
+    # SQLite connections must not be shared with forked worker processes:
+    return _open_cache(os.getpid())
@@ -0,0 +1,292 @@
+import sqlite3
+import logging
+import multiprocessing
+from pathlib import Path
+from collections import deque
+from datetime import datetime, timedelta
+from urllib.parse import urljoin, urlparse
+from concurrent.futures import Future, ProcessPoolExecutor, ThreadPoolExecutor
+from concurrent.futures import FIRST_COMPLETED, wait
+from typing import Any, Deque, Dict, Generator, Iterable, List, Optional, Set, Tuple
+import orjson
+from lxml import html
+from lxml.etree import ParserError
+from articledata import URL, Article
+from pydantic import parse_obj_as
+
+from storyweb.models import Source
+from storyweb.parse.extract import extract, detect_in_batches
+from storyweb.parse.fetch import HostLimiter, fetch_response, THREADS
+
+log = logging.getLogger(__name__)
+
+# Politeness: requests to a single host are made one at a time, and at least
+# DELAY seconds apart.
+HOST_LIMIT = 1
+DELAY = 1.0
+RECRAWL_DAYS = 30
+MIN_TEXT = 500
+SKIP_SUFFIXES = {
+    ".pdf",
+    ".jpg",
+    ".jpeg",
+    ".png",
+    ".gif",
+    ".svg",
+    ".zip",
+    ".mp3",
+    ".mp4",
+    ".doc",
+    ".docx",
+    ".xls",
+    ".xlsx",
+}
+
+Page = Tuple[str, str, bytes]
+
+
+def load_sources(path: Path, names: Iterable[str] = []) -> List[Source]:
+    """Load the list of publishers from a `sources.json` file, optionally only
+    those with the given names."""
+    with open(path, "rb") as fh:
+        sources = parse_obj_as(List[Source], orjson.loads(fh.read()))
+    names = set(n.lower() for n in names)
+    if len(names):
+        sources = [s for s in sources if s.name.lower() in names]
+    return sources
+
+
+def _host(url: str) -> Optional[str]:
+    host = urlparse(url).hostname
+    if host is None:
+        return None
+    host = host.lower()
+    if host.startswith("www."):
+        host = host[4:]
+    return host
+
+
+def clean_url(url: str, hosts: Set[str]) -> Optional[str]:
+    """Normalise a link, or return `None` if it should not be crawled."""
+    try:
+        parsed = urlparse(url)
+    except ValueError:
+        return None
+    if parsed.scheme not in ("http", "https"):
+        return None
+    if _host(url) not in hosts:
+        return None
+    if Path(parsed.path).suffix.lower() in SKIP_SUFFIXES:
+        return None
+    return parsed._replace(query="", fragment="").geturl()
+
+
+class CrawlState(object):
+    """The seen-URL store of the crawler: every discovered page is recorded, so
+    that an interrupted crawl can resume and a later one can skip known articles
+    and make conditional requests for all other pages. Pages are marked with the
+    run in which they were last discovered, so that each is only queued once per
+    crawl. The links found on pages which are not articles are stored as well, to
+    follow them again when such a page has not changed."""
+
+    def __init__(self, path: Path):
+        path.parent.mkdir(parents=True, exist_ok=True)
+        self.run = datetime.utcnow().isoformat()
+        self.db = sqlite3.connect(path.as_posix())
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute(
+            "CREATE TABLE IF NOT EXISTS page (url TEXT PRIMARY KEY, etag TEXT, "
+            "last_modified TEXT, is_article INTEGER, crawled_at TEXT, run TEXT)"
+        )
+        self.db.execute(
+            "CREATE TABLE IF NOT EXISTS link (page TEXT, url TEXT, "
+            "PRIMARY KEY (page, url))"
+        )
+        columns = [row[1] for row in self.db.execute("PRAGMA table_info(page)")]
+        if "run" not in columns:
+            self.db.execute("ALTER TABLE page ADD COLUMN run TEXT")
+        self.db.commit()
+
+    def queued(self) -> List[str]:
+        query = "SELECT url FROM page WHERE crawled_at IS NULL"
+        return [url for (url,) in self.db.execute(query)]
+
+    def get(self, url: str) -> Optional[Tuple[Any, ...]]:
+        query = "SELECT etag, last_modified, is_article, crawled_at FROM page "
+        query += "WHERE url = ?"
+        return self.db.execute(query, (url,)).fetchone()
+
+    def discover(self, urls: Iterable[str]) -> List[str]:
+        """Record pages as discovered in this run, and return those which were
+        not discovered in it before."""
+        query = "INSERT INTO page (url, run) VALUES (?, ?) ON CONFLICT (url) "
+        query += "DO UPDATE SET run = excluded.run WHERE page.run IS NOT excluded.run"
+        fresh: List[str] = []
+        for url in urls:
+            self.db.execute(query, (url, self.run))
+            (changes,) = self.db.execute("SELECT changes()").fetchone()
+            if changes > 0:
+                fresh.append(url)
+        self.db.commit()
+        return fresh
+
+    def links(self, url: str) -> List[str]:
+        query = "SELECT url FROM link WHERE page = ?"
+        return [link for (link,) in self.db.execute(query, (url,))]
+
+    def crawled(
+        self,
+        url: str,
+        etag: Optional[str],
+        last_modified: Optional[str],
+        is_article: bool,
+        links: Iterable[str] = [],
+    ) -> None:
+        query = "INSERT OR REPLACE INTO page VALUES (?, ?, ?, ?, ?, ?)"
+        now = datetime.utcnow().isoformat()
+        row = (url, etag, last_modified, is_article, now, self.run)
+        self.db.execute(query, row)
+        self.db.execute("DELETE FROM link WHERE page = ?", (url,))
+        if not is_article:
+            query = "INSERT OR IGNORE INTO link (page, url) VALUES (?, ?)"
+            self.db.executemany(query, ((url, link) for link in links))
+        self.db.commit()
+
+    def touch(self, url: str) -> None:
+        query = "UPDATE page SET crawled_at = ? WHERE url = ?"
+        self.db.execute(query, (datetime.utcnow().isoformat(), url))
+        self.db.commit()
+
+
+def is_article(doc: html.HtmlElement) -> bool:
+    for og_type in doc.xpath('//meta[@property="og:type"]/@content'):
+        if og_type.strip().lower() == "article":
+            return True
+    return len(doc.findall(".//article")) == 1
+
+
+def parse_page(page: Page) -> Tuple[List[str], Optional[Article]]:
+    """Find the outgoing links of a page, and extract the article it contains,
+    if any. This runs in the worker processes, the language of the article is
+    detected later on in batches."""
+    url, base_url, content = page
+    try:
+        doc = html.fromstring(content)
+    except (ParserError, ValueError):
+        return [], None
+    links = [urljoin(base_url, href) for href in doc.xpath("//a/@href")]
+    if not is_article(doc):
+        return links, None
+    try:
+        article = extract(URL(url), doc, detect=False)
+    except Exception as exc:
+        log.warning("Cannot extract article [%s]: %r", url, exc)
+        return links, None
+    if article is None or len(article.text) < MIN_TEXT:
+        return links, None
+    return links, article
+
+
+def crawl_sources(
+    sources: List[Source],
+    state_path: Path,
+    workers: int = 1,
+    threads: int = THREADS,
+    recrawl_days: int = RECRAWL_DAYS,
+    max_pages: Optional[int] = None,
+) -> Generator[Article, None, None]:
+    """Crawl the websites of the given sources and generate the articles found on
+    them. Downloads run in a pool of threads and parsing in a pool of processes;
+    no more pages are requested while the consumer of the generator is busy."""
+    articles = _crawl(sources, state_path, workers, threads, recrawl_days, max_pages)
+    yield from detect_in_batches(articles)
+
+
+def _crawl(
+    sources: List[Source],
+    state_path: Path,
+    workers: int,
+    threads: int,
+    recrawl_days: int,
+    max_pages: Optional[int],
+) -> Generator[Article, None, None]:
+    state = CrawlState(state_path)
+    limiter = HostLimiter(limit=HOST_LIMIT, delay=DELAY)
+    hosts: Set[str] = set()
+    start_urls: List[str] = []
+    for source in sources:
+        host = _host(source.url)
+        if host is not None:
+            hosts.add(host)
+            start_urls.append(source.url)
+    start_urls.extend(url for url in state.queued() if _host(url) in hosts)
+    frontier: Deque[str] = deque(state.discover(start_urls))
+    recrawl_after = (datetime.utcnow() - timedelta(days=recrawl_days)).isoformat()
+    fetched = 0
+    skipped = 0
+
+    # The downloads are running in threads when the worker processes start:
+    context = multiprocessing.get_context("spawn")
+    with ThreadPoolExecutor(max_workers=threads) as fetcher:
+        with ProcessPoolExecutor(max_workers=workers, mp_context=context) as parser:
+            fetching: Dict[Future[Any], str] = {}
+            parsing: Dict[Future[Any], Tuple[str, Optional[str], Optional[str]]] = {}
+            while len(frontier) or len(fetching) or len(parsing):
+                while len(frontier) and len(fetching) < threads * 2:
+                    if len(parsing) >= workers * 4:
+                        break
+                    if max_pages is not None and fetched >= max_pages:
+                        frontier.clear()
+                        break
+                    url = frontier.popleft()
+                    headers: Dict[str, str] = {}
+                    known = state.get(url)
+                    if known is not None:
+                        etag, last_modified, known_article, crawled_at = known
+                        if known_article and crawled_at > recrawl_after:
+                            skipped += 1
+                            continue
+                        if etag is not None:
+                            headers["If-None-Match"] = etag
+                        if last_modified is not None:
+                            headers["If-Modified-Since"] = last_modified
+                    future = fetcher.submit(fetch_response, url, headers, limiter)
+                    fetching[future] = url
+                    fetched += 1
+
+                pending = list(fetching.keys()) + list(parsing.keys())
+                if not len(pending):
+                    continue
+                done, _ = wait(pending, return_when=FIRST_COMPLETED)
+                for future in done:
+                    if future in fetching:
+                        url = fetching.pop(future)
+                        res = future.result()
+                        if res is None:
+                            state.crawled(url, None, None, False)
+                            continue
+                        if res.status_code == 304:
+                            # The links of an unchanged index page may lead to
+                            # new articles further down:
+                            state.touch(url)
+                            frontier.extend(state.discover(state.links(url)))
+                            continue
+                        content_type = res.headers.get("Content-Type", "html")
+                        if "html" not in content_type.lower():
+                            state.crawled(url, None, None, False)
+                            continue
+                        page = (url, res.url, res.content)
+                        etag = res.headers.get("ETag")
+                        modified = res.headers.get("Last-Modified")
+                        parsing[parser.submit(parse_page, page)] = (url, etag, modified)
+                        continue
+
+                    url, etag, modified = parsing.pop(future)
+                    links, article = future.result()
+                    cleaned = (clean_url(link, hosts) for link in links)
+                    urls = [u for u in cleaned if u is not None]
+                    state.crawled(url, etag, modified, article is not None, urls)
+                    frontier.extend(state.discover(urls))
+                    if article is not None:
+                        yield article
+    log.info("Crawl finished: %d pages requested, %d known skipped", fetched, skipped)
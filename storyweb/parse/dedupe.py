@@ -0,0 +1,194 @@
+import re
+import zlib
+import logging
+import hashlib
+import numpy as np
+from typing import Dict, Generator, Iterable, List, Optional, Set, Tuple
+
+from storyweb.db import Conn, engine
+from storyweb.models import ArticleDetails
+from storyweb.logic.duplicates import fetch_band_matches, fetch_signatures
+from storyweb.logic.duplicates import save_signatures
+from storyweb.parse.util import chunked
+
+log = logging.getLogger(__name__)
+
+# A signature of NUM_PERM min-hashes is split into BANDS bands for the locality-
+# sensitive lookup. With 16 bands of 8 rows, pairs of texts above a Jaccard
+# similarity of about 0.7 are likely to share at least one band:
+NUM_PERM = 128
+BANDS = 16
+ROWS = NUM_PERM // BANDS
+SHINGLE_SIZE = 5
+MIN_SHINGLES = 50
+THRESHOLD = 0.9
+CHECK_SIZE = 1000
+
+PRIME = np.uint64((1 << 61) - 1)
+_perms = np.random.RandomState(seed=23)
+PERM_A = _perms.randint(1, 1 << 32, size=NUM_PERM, dtype=np.uint64)
+PERM_B = _perms.randint(0, 1 << 32, size=NUM_PERM, dtype=np.uint64)
+TOKENS = re.compile(r"\w+", re.U)
+
+Signature = np.ndarray
+Band = Tuple[int, int]
+
+
+def shingles(text: str) -> Set[int]:
+    tokens = TOKENS.findall(text.lower())
+    hashes: Set[int] = set()
+    for i in range(len(tokens) - SHINGLE_SIZE + 1):
+        shingle = " ".join(tokens[i : i + SHINGLE_SIZE])
+        hashes.add(zlib.crc32(shingle.encode("utf-8")))
+    return hashes
+
+
+def minhash(text: str) -> Optional[Signature]:
+    """Compute the MinHash signature of a text over its word 5-grams. Texts which
+    are too short to be compared meaningfully get no signature."""
+    hashes = shingles(text)
+    if len(hashes) < MIN_SHINGLES:
+        return None
+    values = np.fromiter(hashes, dtype=np.uint64, count=len(hashes))
+    signature = np.full(NUM_PERM, PRIME, dtype=np.uint64)
+    for chunk in np.array_split(values, max(1, len(values) // 5000)):
+        permuted = (np.outer(PERM_A, chunk) + PERM_B[:, None]) % PRIME
+        np.minimum(signature, permuted.min(axis=1), out=signature)
+    return signature
+
+
+def bands(signature: Signature) -> List[Band]:
+    """Hash each band of the signature into a (band, bucket) key."""
+    keys: List[Band] = []
+    for band in range(BANDS):
+        rows = signature[band * ROWS : (band + 1) * ROWS]
+        digest = hashlib.blake2b(rows.tobytes(), digest_size=8).digest()
+        keys.append((band, int.from_bytes(digest, "big", signed=True)))
+    return keys
+
+
+def similarity(left: Signature, right: Signature) -> float:
+    return float(np.mean(left == right))
+
+
+def to_bytes(signature: Signature) -> bytes:
+    return signature.astype("<u8").tobytes()
+
+
+def from_bytes(data: bytes) -> Signature:
+    return np.frombuffer(data, dtype="<u8").astype(np.uint64)
+
+
+class DuplicateIndex(object):
+    """Mark articles whose text is a near-duplicate of an article seen earlier,
+    e.g. a story syndicated to several sites. Marked articles are stored, but do
+    not go through NER. All other articles are added to the MinHash index.
+
+    The index entries of an article are only written by `save`, in the same
+    transaction as the batch which contains the article. Until then, they are
+    kept here and matched in memory."""
+
+    def __init__(self) -> None:
+        # The signature and band keys of each checked article, or `None` if the
+        # article is a duplicate or too short to be indexed:
+        self.pending: Dict[str, Optional[Tuple[Signature, List[Band]]]] = {}
+        self.buckets: Dict[Band, List[str]] = {}
+
+    def detect(
+        self, articles: Iterable[Tuple[int, ArticleDetails]]
+    ) -> Generator[Tuple[int, ArticleDetails], None, None]:
+        for chunk in chunked(articles, CHECK_SIZE):
+            self._detect_chunk([a for (_, a) in chunk])
+            yield from chunk
+
+    def _detect_chunk(self, chunk: List[ArticleDetails]) -> None:
+        signatures: Dict[str, Signature] = {}
+        keys: Dict[str, List[Band]] = {}
+        for article in chunk:
+            article.duplicate_of = None
+            signature = minhash(article.text)
+            if signature is not None:
+                signatures[article.id] = signature
+                keys[article.id] = bands(signature)
+
+        all_keys = set(k for ks in keys.values() for k in ks)
+        with engine.connect() as conn:
+            matches = fetch_band_matches(conn, all_keys)
+            known = set(a for arts in matches.values() for a in arts)
+            known.difference_update(signatures.keys())
+            known.difference_update(self.pending.keys())
+            stored = {
+                id: from_bytes(data)
+                for (id, data) in fetch_signatures(conn, known).items()
+            }
+        for key in all_keys:
+            for id in self.buckets.get(key, []):
+                matches.setdefault(key, []).append(id)
+
+        duplicates = 0
+        for article in chunk:
+            signature = signatures.get(article.id)
+            if signature is None:
+                self._add(article.id, None)
+                continue
+            candidates: Set[str] = set()
+            for key in keys[article.id]:
+                candidates.update(matches.get(key, []))
+            best = THRESHOLD
+            for candidate in sorted(candidates):
+                other = self._signature(candidate, stored)
+                if candidate == article.id or other is None:
+                    continue
+                score = similarity(signature, other)
+                if score >= best:
+                    article.duplicate_of = candidate
+                    best = score
+            if article.duplicate_of is not None:
+                duplicates += 1
+                self._add(article.id, None)
+            else:
+                # Later articles are compared to this one:
+                self._add(article.id, (signature, keys[article.id]))
+                for key in keys[article.id]:
+                    matches.setdefault(key, []).append(article.id)
+        if duplicates > 0:
+            log.info("Found %d near-duplicate articles", duplicates)
+
+    def _signature(self, id: str, stored: Dict[str, Signature]) -> Optional[Signature]:
+        entry = self.pending.get(id)
+        if entry is not None:
+            return entry[0]
+        if id in self.pending:
+            return None
+        return stored.get(id)
+
+    def _add(self, id: str, entry: Optional[Tuple[Signature, List[Band]]]) -> None:
+        self._forget(id)
+        self.pending[id] = entry
+        if entry is not None:
+            for key in entry[1]:
+                self.buckets.setdefault(key, []).append(id)
+
+    def _forget(self, id: str) -> Optional[Tuple[Signature, List[Band]]]:
+        entry = self.pending.pop(id, None)
+        if entry is not None:
+            for key in entry[1]:
+                self.buckets[key].remove(id)
+                if not len(self.buckets[key]):
+                    del self.buckets[key]
+        return entry
+
+    def save(self, conn: Conn, ids: Iterable[str]) -> None:
+        """Write the index entries of the given articles, replacing any earlier
+        ones, once the articles themselves are saved."""
+        ids = [id for id in set(ids) if id in self.pending]
+        if not len(ids):
+            return
+        values: Dict[str, bytes] = {}
+        keys: Dict[str, List[Band]] = {}
+        for id in ids:
+            entry = self._forget(id)
+            if entry is not None:
+                values[id] = to_bytes(entry[0])
+                keys[id] = entry[1]
+        save_signatures(conn, ids, values, keys)
@@ -1,15 +1,20 @@
 import logging
 from datetime import datetime
-from typing import Optional, Dict, Any
+from typing import Optional, Dict, Any, Generator, Iterable, List, Tuple
 from articledata import URL, Article
 from trafilatura import bare_extraction
 
-from storyweb.parse.language import detect_language
+from storyweb.parse.language import detect_language, detect_languages
+from storyweb.parse.util import chunked, map_ordered
+
+DETECT_SIZE = 100
 
 log = logging.getLogger(__name__)
 
 
-def extract(url: URL, html: Any) -> Optional[Article]:
+def extract(url: URL, html: Any, detect: bool = True) -> Optional[Article]:
+    """Extract the article text and metadata from a HTML page. Bulk imports should
+    pass `detect=False` and then use `detect_article_languages` on a batch."""
     log.info("Parsing: %r", url)
     article = Article(
         id=url.id,
@@ -25,14 +30,52 @@ def extract(url: URL, html: Any) -> Optional[Article]:
 
     extract: Dict[str, str] = bare_extraction(html, url=url.url, include_comments=False)
     if extract is not None:
-        article.title = extract.get("title", article.title)
+        article.title = extract.get("title") or article.title
         article.date = extract.get("date")
-        article.text = extract.get("text", article.text)
+        article.text = extract.get("text") or article.text
         author = extract.get("author")
         if author is not None:
             article.bylines.append(author)
 
-    lang = detect_language(article.text)
-    if lang is not None:
-        article.language = lang
+    if detect:
+        lang = detect_language(article.text)
+        if lang is not None:
+            article.language = lang
     return article
+
+
+def detect_article_languages(articles: List[Article]) -> None:
+    langs = detect_languages([article.text for article in articles])
+    for article, lang in zip(articles, langs):
+        if lang is not None:
+            article.language = lang
+
+
+def detect_in_batches(articles: Iterable[Article]) -> Generator[Article, None, None]:
+    """Detect the languages of a stream of articles, a batch at a time."""
+    for batch in chunked(articles, DETECT_SIZE):
+        detect_article_languages(batch)
+        yield from batch
+
+
+def extract_page(page: Tuple[str, bytes]) -> Optional[Article]:
+    url, content = page
+    try:
+        return extract(URL(url), content, detect=False)
+    except Exception as exc:
+        log.warning("Cannot extract article [%s]: %r", url, exc)
+        return None
+
+
+def extract_pages(
+    pages: Iterable[Tuple[str, bytes]],
+    workers: int = 1,
+    context: Optional[str] = None,
+    min_text: int = 0,
+) -> Generator[Article, None, None]:
+    """Extract articles from many (URL, HTML) pairs using a pool of worker
+    processes, and detect their languages in batches. Only a bounded number of
+    pages is in flight at any time."""
+    results = map_ordered(extract_page, pages, workers=workers, context=context)
+    articles = (a for (_, a) in results if a is not None and len(a.text) >= min_text)
+    yield from detect_in_batches(articles)
@@ -0,0 +1,154 @@
+import time
+import hashlib
+import logging
+import threading
+import requests
+from contextlib import contextmanager
+from pathlib import Path
+from urllib.parse import urlparse
+from functools import cache
+from collections import deque
+from concurrent.futures import Future, ThreadPoolExecutor
+from requests.adapters import HTTPAdapter
+from typing import Deque, Dict, Generator, Iterable, Optional, Tuple
+
+from storyweb import settings
+
+log = logging.getLogger(__name__)
+
+TIMEOUT = 30
+THREADS = 16
+HOST_LIMIT = 4
+USER_AGENT = "Mozilla/5.0 (compatible; storyweb/0.0.1)"
+
+
+class ResponseCache(object):
+    """A directory of raw HTTP response bodies, keyed by a hash of the URL."""
+
+    def __init__(self, path: Path):
+        self.path = path
+
+    def _key_path(self, url: str) -> Path:
+        key = hashlib.sha1(url.encode("utf-8")).hexdigest()
+        return self.path.joinpath(key[:2], key)
+
+    def get(self, url: str) -> Optional[bytes]:
+        path = self._key_path(url)
+        if not path.exists():
+            return None
+        return path.read_bytes()
+
+    def put(self, url: str, content: bytes) -> None:
+        path = self._key_path(url)
+        path.parent.mkdir(parents=True, exist_ok=True)
+        # Write to a temporary file first, so that readers never see a partial
+        # response:
+        tmp_path = path.with_suffix(f".{threading.get_ident()}.tmp")
+        tmp_path.write_bytes(content)
+        tmp_path.replace(path)
+
+
+@cache
+def get_response_cache() -> Optional[ResponseCache]:
+    if settings.HTTP_CACHE is None:
+        return None
+    path = Path(settings.HTTP_CACHE)
+    log.info("Using HTTP response cache: %s", path)
+    return ResponseCache(path)
+
+
+class HostLimiter(object):
+    """Limit the number of concurrent requests made to any one host, and
+    optionally keep a minimum delay between the start of those requests."""
+
+    def __init__(self, limit: int = HOST_LIMIT, delay: float = 0.0):
+        self.limit = limit
+        self.delay = delay
+        self.lock = threading.Lock()
+        self.hosts: Dict[str, threading.BoundedSemaphore] = {}
+        self.next_start: Dict[str, float] = {}
+
+    @contextmanager
+    def slot(self, url: str) -> Generator[None, None, None]:
+        host = urlparse(url).netloc.lower()
+        with self.lock:
+            if host not in self.hosts:
+                self.hosts[host] = threading.BoundedSemaphore(self.limit)
+            semaphore = self.hosts[host]
+        with semaphore:
+            if self.delay > 0:
+                with self.lock:
+                    now = time.monotonic()
+                    start = max(now, self.next_start.get(host, now))
+                    self.next_start[host] = start + self.delay
+                time.sleep(start - now)
+            yield
+
+
+_local = threading.local()
+_limiter = HostLimiter()
+
+
+def get_session() -> requests.Session:
+    # Sessions are not guaranteed to be thread-safe, so each thread keeps its own
+    # pool of connections:
+    session = getattr(_local, "session", None)
+    if session is None:
+        session = requests.Session()
+        session.headers["User-Agent"] = USER_AGENT
+        adapter = HTTPAdapter(pool_connections=THREADS, pool_maxsize=HOST_LIMIT)
+        session.mount("http://", adapter)
+        session.mount("https://", adapter)
+        _local.session = session
+    return session
+
+
+def fetch_response(
+    url: str,
+    headers: Optional[Dict[str, str]] = None,
+    limiter: Optional[HostLimiter] = None,
+) -> Optional[requests.Response]:
+    """Make a GET request, subject to the per-host limit. Error responses other
+    than `304 Not Modified` are logged and return `None`."""
+    limiter = limiter or _limiter
+    try:
+        with limiter.slot(url):
+            res = get_session().get(url, headers=headers, timeout=TIMEOUT)
+        if res.status_code != 304:
+            res.raise_for_status()
+        return res
+    except Exception as exc:
+        log.warning("Cannot fetch [%s]: %r", url, exc)
+        return None
+
+
+def fetch_page(url: str) -> Optional[bytes]:
+    """Fetch the body of a web page, using the response cache if configured."""
+    cache = get_response_cache()
+    if cache is not None:
+        content = cache.get(url)
+        if content is not None:
+            return content
+    res = fetch_response(url)
+    if res is None:
+        return None
+    if cache is not None:
+        cache.put(url, res.content)
+    return res.content
+
+
+def fetch_pages(
+    urls: Iterable[str], threads: int = THREADS
+) -> Generator[Tuple[str, Optional[bytes]], None, None]:
+    """Fetch many web pages concurrently. Pages are returned in the order of the
+    given URLs, with `None` for those which could not be fetched."""
+    with ThreadPoolExecutor(max_workers=threads) as executor:
+        pending: Deque[Tuple[str, Future[Optional[bytes]]]] = deque()
+        for url in urls:
+            pending.append((url, executor.submit(fetch_page, url)))
+            if len(pending) >= threads * 4:
+                url, future = pending.popleft()
+                yield (url, future.result())
+        while len(pending):
+            url, future = pending.popleft()
+            yield (url, future.result())
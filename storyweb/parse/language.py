@@ -1,11 +1,18 @@
+import hashlib
+from collections import OrderedDict
 from functools import cache
-from typing import Optional
+from typing import Dict, List, Optional, Sequence
 import fasttext
 import languagecodes
 from normality import collapse_spaces
 from pathlib import Path
 
 model_path = Path(__file__).parent / "lid.176.ftz"
+MAX_CHARS = 10000
+MEMO_SIZE = 100000
+
+# Detected languages by text hash, in least-recently used order:
+_memo: "OrderedDict[str, Optional[str]]" = OrderedDict()
 
 
 @cache
@@ -18,17 +25,43 @@ def get_model():
     return fasttext.load_model(model_path.as_posix())
 
 
+def _parse_label(label: str) -> Optional[str]:
+    lang = label.replace("__label__", "")
+    return languagecodes.iso_639_alpha3(lang)
+
+
+def detect_languages(texts: Sequence[Optional[str]]) -> List[Optional[str]]:
+    """Detect the language of many texts at once, running the model only once for
+    all of those which have not been seen recently."""
+    results: List[Optional[str]] = [None for _ in texts]
+    pending: Dict[str, List[int]] = {}
+    samples: Dict[str, str] = {}
+    for idx, text in enumerate(texts):
+        if text is None:
+            continue
+        sample = collapse_spaces(text[:MAX_CHARS])
+        if sample is None:
+            continue
+        key = hashlib.sha1(sample.encode("utf-8")).hexdigest()
+        if key in _memo:
+            _memo.move_to_end(key)
+            results[idx] = _memo[key]
+            continue
+        pending.setdefault(key, []).append(idx)
+        samples[key] = sample
+
+    if len(samples):
+        labels, _ = get_model().predict(list(samples.values()))
+        for key, label in zip(samples.keys(), labels):
+            lang = _parse_label(label[0]) if len(label) else None
+            for idx in pending[key]:
+                results[idx] = lang
+            _memo[key] = lang
+        while len(_memo) > MEMO_SIZE:
+            _memo.popitem(last=False)
+    return results
+
+
 def detect_language(text: Optional[str]) -> Optional[str]:
-    model = get_model()
-    text = collapse_spaces(text)
-    if text is None:
-        return text
-    out = model.predict(text[:10000])
-    if not len(out):
-        return None
-    ((lang,), _) = out
-    lang = lang.replace("__label__", "")
-    lang_long = languagecodes.iso_639_alpha3(lang)
-    if lang_long is not None:
-        return lang_long
-    return None
+    (lang,) = detect_languages([text])
+    return lang
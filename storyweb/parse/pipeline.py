@@ -1,19 +1,33 @@
+import time
 import spacy
 import logging
 import hashlib
-from spacy.tokens import Span, Doc
+from spacy.language import Language
+from spacy.tokens import Span, Doc, DocBin
 from pathlib import Path
-from typing import Dict, Generator, List, Optional, Set, Tuple
-from functools import cache
+from typing import Dict, Generator, Iterable, List, Optional, Set, Tuple, Union
+from collections import Counter
+from functools import cache, lru_cache
 from normality import slugify
 from articledata import Article
-from pydantic import ValidationError
 
 from storyweb.db import engine, Conn
 from storyweb.clean import clean_entity_name, most_common, pick_name
-from storyweb.models import ArticleDetails, Sentence, Tag, TagSentence
-from storyweb.logic.articles import save_extracted
+from storyweb.models import ArticleDetails, ExtractedArticle
+from storyweb.models import Mention, Sentence, Tag, TagSentence
+from storyweb.logic.articles import save_extracted, save_extracted_batch
+from storyweb.logic.articles import stream_articles
+from storyweb.logic.imports import fetch_article_hashes
+from storyweb.logic.imports import shard_table, count_shards
+from storyweb.logic.util import copy_rows, create_stage
+from storyweb.logic.imports import fetch_checkpoint, save_checkpoint, clear_checkpoint
 from storyweb.ontology import ClusterType
+from storyweb.parse.cache import get_annotation_cache
+from storyweb.parse.dedupe import DuplicateIndex
+from storyweb.parse.profile import Profile
+from storyweb.parse.reader import read_raw_articles
+from storyweb.parse.util import chunked, chunked_budget, map_ordered
+from storyweb.parse.util import Shard, shard_of
 
 log = logging.getLogger(__name__)
 
@@ -30,6 +44,31 @@ NLP_MODELS = {
     "rus": "ru_core_news_sm",
     "xxx": "xx_ent_wiki_sm",
 }
+# Annotations retained when NER results are cached:
+CACHE_ATTRS = ["ENT_IOB", "ENT_TYPE", "SENT_START"]
+# The number of distinct surface forms for which `clean_tag` memoises its
+# result, in each worker process:
+TAG_CACHE_SIZE = 500_000
+# Each `nlp.pipe` batch is limited both by the number of texts and by their size,
+# and each unit of work handed to a worker process is a few such batches. Texts
+# longer than SEGMENT_CHARS are split into segments at paragraph boundaries.
+BATCH_SIZE = 20
+BATCH_CHARS = 200_000
+WORK_SIZE = BATCH_SIZE * 5
+WORK_CHARS = BATCH_CHARS * 5
+SEGMENT_CHARS = 50_000
+SEPARATORS = ("\n\n", "\n", ". ", " ")
+CHECK_SIZE = 1000
+# Change this whenever a change to the tag extraction logic should cause all
+# articles to be processed again on the next import:
+PIPELINE_VERSION = "1"
+
+
+def nlp_language(language: Optional[str]) -> str:
+    """Pick the key of the NER model used for articles in the given language."""
+    if language is None or language not in NLP_MODELS:
+        return "xxx"
+    return language
 
 
 @cache
@@ -46,87 +85,208 @@ def load_nlp(language: str):
     return nlp
 
 
-def read_raw_articles(path: Path) -> Generator[Tuple[str, Article], None, None]:
-    with open(path, "rb") as fh:
-        while line := fh.readline():
-            try:
-                article = Article.parse_raw(line)
-                if article.id is None:
-                    continue
-                if article.language != "eng":
+def article_hash(article: ArticleDetails) -> str:
+    """Fingerprint the article content as it is seen by the extraction pipeline."""
+    model = NLP_MODELS[nlp_language(article.language)]
+    digest = hashlib.sha1()
+    parts = (PIPELINE_VERSION, model, article.language, article.title, article.text)
+    for part in parts:
+        digest.update((part or "").encode("utf-8"))
+        digest.update(b"\x00")
+    return digest.hexdigest()
+
+
+def make_article(raw: Union[Article, ArticleDetails]) -> ArticleDetails:
+    article = ArticleDetails(
+        id=raw.id,
+        site=raw.site,
+        url=raw.url,
+        title=raw.title,
+        language=raw.language,
+        text=raw.text,
+    )
+    article.hash = article_hash(article)
+    if isinstance(raw, ArticleDetails):
+        article.duplicate_of = raw.duplicate_of
+    return article
+
+
+def skip_unchanged(
+    articles: Iterable[Tuple[int, ArticleDetails]], dedupe: bool = True
+) -> Generator[Tuple[int, ArticleDetails], None, None]:
+    """Drop all articles which have already been imported with the same content
+    hash, so that they do not have to go through NER again. Without `dedupe`,
+    articles which were stored as near-duplicates (and thus without tags) are
+    kept, so that they are extracted this time."""
+    for chunk in chunked(articles, CHECK_SIZE):
+        with engine.connect() as conn:
+            hashes = fetch_article_hashes(conn, [a.id for (_, a) in chunk])
+        skipped = 0
+        for (position, article) in chunk:
+            if article.id in hashes:
+                hash, duplicate_of = hashes[article.id]
+                if hash == article.hash and (dedupe or duplicate_of is None):
+                    skipped += 1
                     continue
-                yield (article.text, article)
-            except ValidationError as ve:
-                log.warn("Article validation [%s]: %s", article.id, ve)
+            yield (position, article)
+        if skipped > 0:
+            log.info("Skipped %d unchanged articles", skipped)
 
 
-def extract_tag(ent: Span) -> Optional[Tuple[str, str, str]]:
-    tag_type = NLP_TYPES.get(ent.label_)
-    if tag_type is None:
-        return None
-    label = clean_entity_name(ent.text)
+def bucket_languages(
+    articles: Iterable[Tuple[int, ArticleDetails]], offset: int = 0
+) -> Generator[Tuple[str, List[ArticleDetails], int], None, None]:
+    """Route articles into per-language queues, and emit a batch whenever one of
+    the queues is full. Each batch is returned with the offset from which reading
+    would have to resume once it and all preceding batches have been saved."""
+    buckets: Dict[str, List[ArticleDetails]] = {}
+    chars: Dict[str, int] = {}
+    starts: Dict[str, int] = {}
+    position = offset
+    for (end, article) in articles:
+        language = nlp_language(article.language)
+        if language not in buckets:
+            buckets[language] = []
+            chars[language] = 0
+            starts[language] = position
+        buckets[language].append(article)
+        chars[language] += len(article.text)
+        position = end
+        if len(buckets[language]) >= WORK_SIZE or chars[language] >= WORK_CHARS:
+            batch = buckets.pop(language)
+            chars.pop(language)
+            starts.pop(language)
+            yield (language, batch, min(starts.values(), default=position))
+
+    while len(buckets):
+        language = min(starts, key=lambda lang: starts[lang])
+        batch = buckets.pop(language)
+        starts.pop(language)
+        yield (language, batch, min(starts.values(), default=position))
+
+
+@lru_cache(maxsize=TAG_CACHE_SIZE)
+def clean_tag(text: str, tag_type: str) -> Optional[Tuple[str, str]]:
+    """Derive the label and fingerprint for an entity mention. The same surface
+    forms recur all across the corpus, so the results are memoised."""
+    label = clean_entity_name(text)
     fp = slugify(label, sep="-")
     if fp is None or label is None:
         return None
     fp = "-".join(sorted(fp.split("-")))
     if tag_type == ClusterType.PERSON and " " not in label:
         return None
+    return (label, fp)
+
+
+def tag_cache_stats() -> str:
+    info = clean_tag.cache_info()
+    lookups = max(1, info.hits + info.misses)
+    rate = (info.hits / lookups) * 100
+    return f"{info.hits} hits, {info.misses} misses ({rate:.1f}%), {info.currsize} kept"
+
+
+def extract_tag(ent: Span) -> Optional[Tuple[str, str, str]]:
+    tag_type = NLP_TYPES.get(ent.label_)
+    if tag_type is None:
+        return None
+    cleaned = clean_tag(ent.text, tag_type)
+    if cleaned is None:
+        return None
+    label, fp = cleaned
     return (label, tag_type, fp)
 
 
-def _load_article(conn: Conn, doc: Doc, raw: Article) -> str:
-    log.info("Article [%s, %s]: %r", raw.id, raw.language, raw.title)
-    article = ArticleDetails(
-        id=raw.id,
-        site=raw.site,
-        url=raw.url,
-        title=raw.title,
-        language=raw.language,
-        text=raw.text,
-    )
+def split_text(text: str, limit: int = SEGMENT_CHARS) -> List[str]:
+    """Split a long text into segments of at most `limit` characters, preferring
+    to cut at paragraph boundaries. The segments add up to the original text."""
+    segments: List[str] = []
+    start = 0
+    while len(text) - start > limit:
+        window = text[start : start + limit]
+        cut = limit
+        for sep in SEPARATORS:
+            pos = window.rfind(sep)
+            if pos > 0:
+                cut = pos + len(sep)
+                break
+        segments.append(text[start : start + cut])
+        start += cut
+    segments.append(text[start:])
+    return segments
+
+
+def _sentences(docs: Iterable[Doc]) -> Generator[Tuple[int, Span], None, None]:
+    # Segments add up to the article text, so a sentence's offset in the text is
+    # its offset in the segment plus the length of all preceding segments:
+    offset = 0
+    for doc in docs:
+        for sent in doc.sents:
+            yield (offset, sent)
+        offset += len(doc.text)
+
+
+def extract_article(
+    docs: List[Doc], article: ArticleDetails, profile: Optional[Profile] = None
+) -> ExtractedArticle:
+    """Generate tags and tagged sentences for an article, given the NER results
+    for each of its segments."""
+    profile = profile or Profile()
     sentences: List[Sentence] = []
     tag_sentences: Dict[str, Set[int]] = {}
-    tag_types: Dict[str, List[str]] = {}
-    tag_labels: Dict[str, List[str]] = {}
-    for seq, sent in enumerate(doc.sents):
+    tag_types: Dict[str, Counter[str]] = {}
+    tag_labels: Dict[str, Counter[str]] = {}
+    spans: List[Tuple[int, int, str]] = []
+    for seq, (offset, sent) in enumerate(_sentences(docs)):
         sent_tags = 0
         for ent in sent.ents:
+            start = time.perf_counter()
             extracted = extract_tag(ent)
+            profile.charge("extract_tag", start)
             if extracted is None:
                 continue
             (label, type_, fp) = extracted
-            tag_labels.setdefault(fp, [])
-            tag_labels[fp].append(label)
-            tag_types.setdefault(fp, [])
-            tag_types[fp].append(type_)
-            tag_sentences.setdefault(fp, set())
+            if fp not in tag_labels:
+                tag_labels[fp] = Counter()
+                tag_types[fp] = Counter()
+                tag_sentences[fp] = set()
+            tag_labels[fp][label] += 1
+            tag_types[fp][type_] += 1
             tag_sentences[fp].add(seq)
+            spans.append((offset + ent.start_char, offset + ent.end_char, fp))
             sent_tags += 1
 
         if sent_tags > 0:
-            sentence = Sentence(article=article.id, sequence=seq, text=sent.text)
+            sentence = Sentence(
+                article=article.id,
+                sequence=seq,
+                start_char=offset + sent.start_char,
+                end_char=offset + sent.end_char,
+            )
             sentences.append(sentence)
 
     article.tags = len(tag_labels)
-    article.mentions = sum([len(v) for v in tag_labels.values()])
+    article.mentions = sum([sum(v.values()) for v in tag_labels.values()])
     tags: List[Tag] = []
+    tag_ids: Dict[str, str] = {}
     tag_sentence_objs: List[TagSentence] = []
     for fp, labels in tag_labels.items():
         key = f"{article.id}>{fp}".encode("utf-8")
         tag_id = hashlib.sha1(key).hexdigest()
+        tag_ids[fp] = tag_id
         type_ = most_common(tag_types[fp])
+        start = time.perf_counter()
         label = pick_name(labels)
+        profile.charge("pick_name", start)
+        count = sum(labels.values())
         tag = Tag(
             id=tag_id,
-            cluster=tag_id,
             article=article.id,
             fingerprint=fp,
             type=type_,
             label=label,
-            count=len(labels),
-            frequency=float(len(labels)) / article.mentions,
-            cluster_type=type_,
-            cluster_label=label,
+            count=count,
+            frequency=float(count) / article.mentions,
         )
         tags.append(tag)
 
@@ -134,19 +294,272 @@ def _load_article(conn: Conn, doc: Doc, raw: Article) -> str:
             obj = TagSentence(tag=tag_id, article=article.id, sentence=seq)
             tag_sentence_objs.append(obj)
 
-    save_extracted(conn, article, sentences, tag_sentence_objs, tags)
+    mentions: List[Mention] = []
+    for (start, end, fp) in spans:
+        mention = Mention(
+            article=article.id,
+            tag=tag_ids[fp],
+            start_char=start,
+            end_char=end,
+        )
+        mentions.append(mention)
+
+    return ExtractedArticle(
+        article=article,
+        sentences=sentences,
+        tag_sentences=tag_sentence_objs,
+        tags=tags,
+        mentions=mentions,
+    )
+
+
+def _cache_key(nlp: Language, text: str) -> str:
+    meta = nlp.meta
+    model = f"{meta.get('lang')}_{meta.get('name')}@{meta.get('version')}"
+    digest = hashlib.sha1(model.encode("utf-8"))
+    digest.update(b"\x00")
+    digest.update(text.encode("utf-8"))
+    return digest.hexdigest()
+
+
+def _pipe(nlp: Language, texts: Iterable[str]) -> Generator[Doc, None, None]:
+    for batch in chunked_budget(texts, BATCH_SIZE, BATCH_CHARS, len):
+        yield from nlp.pipe(batch, batch_size=len(batch))
+
+
+def annotate(language: str, texts: List[str]) -> List[Doc]:
+    """Run NER on a list of texts, re-using cached annotations where they exist."""
+    nlp = load_nlp(language)
+    cache = get_annotation_cache()
+    if cache is None:
+        return list(_pipe(nlp, texts))
+
+    keys = [_cache_key(nlp, text) for text in texts]
+    docs: Dict[str, Doc] = {}
+    for key, data in cache.get_many(set(keys)).items():
+        for doc in DocBin().from_bytes(data).get_docs(nlp.vocab):
+            docs[key] = doc
+
+    missing = {k: t for (k, t) in zip(keys, texts) if k not in docs}
+    fresh: Dict[str, bytes] = {}
+    parsed = _pipe(nlp, missing.values())
+    for key, doc in zip(missing.keys(), parsed):
+        docs[key] = doc
+        doc_bin = DocBin(attrs=CACHE_ATTRS, store_user_data=False)
+        doc_bin.add(doc)
+        fresh[key] = doc_bin.to_bytes()
+    cache.put_many(fresh)
+    return [docs[key] for key in keys]
+
+
+def extract_articles(
+    language: str, articles: List[ArticleDetails], profile: Optional[Profile] = None
+) -> List[ExtractedArticle]:
+    """Run NER on a batch of articles in the given language. Near-duplicates of
+    other articles are skipped and get no tags."""
+    profile = profile or Profile()
+    segments = [
+        split_text(article.text) if article.duplicate_of is None else []
+        for article in articles
+    ]
+    with profile.timer("nlp"):
+        docs = annotate(language, [text for texts in segments for text in texts])
+    extracted: List[ExtractedArticle] = []
+    offset = 0
+    for article, texts in zip(articles, segments):
+        article_docs = docs[offset : offset + len(texts)]
+        offset += len(texts)
+        with profile.timer("extract"):
+            extracted.append(extract_article(article_docs, article, profile))
+    return extracted
+
+
+def _extract_batch(
+    work: Tuple[str, List[ArticleDetails], int]
+) -> Tuple[List[ExtractedArticle], Profile]:
+    # This is the unit of work handed to the worker processes during an import.
+    # The timings of the batch are sent back along with the results.
+    language, articles, _ = work
+    profile = Profile()
+    extracted = extract_articles(language, articles, profile)
+    log.debug("Tag cleaning cache: %s", tag_cache_stats())
+    return extracted, profile
+
+
+def _log_article(article: ArticleDetails) -> None:
+    log.info("Article [%s, %s]: %r", article.id, article.language, article.title)
+
+
+def _save_article(conn: Conn, extracted: ExtractedArticle) -> str:
+    article = extracted.article
+    _log_article(article)
+    save_extracted(
+        conn,
+        article,
+        extracted.sentences,
+        extracted.tag_sentences,
+        extracted.tags,
+        extracted.mentions,
+    )
     return article.id
 
 
-def load_articles(path: Path) -> None:
-    nlp = load_nlp("eng")
-    raw_articles = read_raw_articles(path)
-    for (doc, raw_article) in nlp.pipe(raw_articles, batch_size=20, as_tuples=True):
+def load_articles(
+    path: Path,
+    workers: int = 1,
+    resume: bool = True,
+    force: bool = False,
+    dedupe: bool = True,
+    shard: Optional[Shard] = None,
+    progress: Optional[float] = None,
+    report: Optional[Path] = None,
+) -> None:
+    """Import the articles from an `articledata` file. With a `shard` (index, count),
+    only the articles whose ID hashes to that shard are imported, so several
+    processes or machines can load disjoint parts of one file into the same
+    database. Every shard keeps its own checkpoint.
+
+    The time spent in each stage of the import is logged at the end, along with
+    the throughput; set `progress` to log a line every so many seconds, and
+    `report` to write the profile to a JSON file."""
+    source = path.resolve().as_posix()
+    if shard is not None:
+        source = f"{source}#{shard[0]}/{shard[1]}"
+        if dedupe:
+            # Which copy of a near-duplicate is the original depends on the order
+            # in which articles are seen, which differs between shards:
+            log.info("Near-duplicate detection is disabled for sharded imports")
+            dedupe = False
+    # The checkpoint only applies to the file as it was when it was saved, an
+    # offset into a file which has since been replaced or changed is meaningless:
+    stat = path.stat()
+    offset = 0
+    if resume:
+        with engine.begin() as conn:
+            offset, size, mtime = fetch_checkpoint(conn, source)
+        if offset > 0 and (size, mtime) != (stat.st_size, stat.st_mtime_ns):
+            log.warning("%s has changed since the checkpoint, restarting", source)
+            offset = 0
+        elif offset > 0:
+            log.info("Resuming import of %s at byte %d", source, offset)
+
+    profile = Profile()
+    raw_articles = read_raw_articles(path, offset=offset, shard=shard)
+    articles = ((pos, make_article(raw)) for (pos, raw) in raw_articles)
+    articles = profile.counted("read", profile.timed("parse", articles))
+    if not force:
+        articles = profile.timed("check", skip_unchanged(articles, dedupe))
+    index = DuplicateIndex()
+    if dedupe:
+        articles = profile.timed("dedupe", index.detect(articles))
+    batches = profile.timed("bucket", bucket_languages(articles, offset=offset))
+    batches = profile.counted("queued", batches)
+    work = map_ordered(_extract_batch, batches, workers=workers)
+    # NER runs in the worker processes, while all database writes happen here,
+    # in the order in which the batches were formed. The checkpoint and the
+    # near-duplicate index are stored in the same transaction as the batch they
+    # refer to:
+    for (_, _, position), (extracted, batch_profile) in profile.timed("wait", work):
+        profile.merge(batch_profile)
+        profile.counters["batches"] += 1
+        profile.depth(profile.counters["queued"] - profile.counters["batches"])
+        for item in extracted:
+            _log_article(item.article)
+            profile.counters["articles"] += 1
+            profile.counters["mentions"] += len(item.mentions)
+            rows = len(item.sentences) + len(item.tags) + len(item.mentions)
+            profile.counters["rows"] += 1 + rows + len(item.tag_sentences)
+        with profile.timer("save"):
+            with engine.begin() as conn:
+                save_extracted_batch(conn, extracted)
+                index.save(conn, [e.article.id for e in extracted])
+                save_checkpoint(
+                    conn, source, position, stat.st_size, stat.st_mtime_ns
+                )
+        if progress is not None:
+            profile.progress(progress)
+
+    with engine.begin() as conn:
+        clear_checkpoint(conn, source)
+    log.info("Import of %s complete", source)
+    profile.summary()
+    if workers <= 1:
+        log.info("Tag cleaning cache: %s", tag_cache_stats())
+    if report is not None:
+        profile.write(report)
+
+
+def shard_report(path: Path, shards: int) -> List[Tuple[int, int, int]]:
+    """Count the distinct articles of each shard in an `articledata` file, and how
+    many of them are in the database, to verify that a sharded import is
+    complete. Only articles which pass validation are counted, as the others are
+    skipped by the import as well. The IDs are counted in the database, rather
+    than in memory. Returns (shard, articles, imported) for each shard."""
+    with engine.begin() as conn:
+        (stage,) = create_stage(conn, shard_table)
+        ids = ((shard_of(a.id, shards), a.id) for (_, a) in read_raw_articles(path))
+        for chunk in chunked(ids, CHECK_SIZE):
+            copy_rows(conn, stage, chunk)
+        counts = count_shards(conn, stage)
+    return [(s, *counts.get(s, (0, 0))) for s in range(1, shards + 1)]
+
+
+def reprocess_articles(
+    workers: int = 1,
+    site: Optional[str] = None,
+    language: Optional[str] = None,
+    story: Optional[int] = None,
+) -> None:
+    """Run the extraction again for articles which are already in the database.
+    Tag IDs are derived from the article ID and the fingerprint, so tags that are
+    found again keep their links and clusters."""
+    with engine.connect() as conn:
+        stored = stream_articles(conn, site=site, language=language, story=story)
+        articles = ((0, make_article(article)) for article in stored)
+        batches = bucket_languages(articles)
+        work = map_ordered(_extract_batch, batches, workers=workers)
+        for _, (extracted, _) in work:
+            for item in extracted:
+                _log_article(item.article)
+            with engine.begin() as wconn:
+                save_extracted_batch(wconn, extracted, prune=True)
+
+
+def import_articles(
+    raw_articles: Iterable[Article],
+    workers: int = 1,
+    force: bool = False,
+    dedupe: bool = True,
+    context: Optional[str] = None,
+) -> List[str]:
+    """Run the extraction for a stream of articles which do not come from a file,
+    in batches, and return the IDs of all of the articles."""
+    ids: List[str] = []
+
+    def _articles() -> Generator[Tuple[int, ArticleDetails], None, None]:
+        for raw in raw_articles:
+            article = make_article(raw)
+            ids.append(article.id)
+            yield (0, article)
+
+    articles: Iterable[Tuple[int, ArticleDetails]] = _articles()
+    if not force:
+        articles = skip_unchanged(articles, dedupe)
+    index = DuplicateIndex()
+    if dedupe:
+        articles = index.detect(articles)
+    batches = bucket_languages(articles)
+    work = map_ordered(_extract_batch, batches, workers=workers, context=context)
+    for _, (extracted, _) in work:
+        for item in extracted:
+            _log_article(item.article)
         with engine.begin() as conn:
-            _load_article(conn, doc, raw_article)
+            save_extracted_batch(conn, extracted)
+            index.save(conn, [e.article.id for e in extracted])
+    return ids
 
 
-def load_one_article(conn: Conn, article: Article) -> str:
-    nlp = load_nlp(article.language)
-    doc = nlp(article.text)
-    return _load_article(conn, doc, article)
+def load_one_article(conn: Conn, raw: Article) -> str:
+    article = make_article(raw)
+    docs = annotate(nlp_language(article.language), split_text(article.text))
+    return _save_article(conn, extract_article(docs, article))
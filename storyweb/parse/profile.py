@@ -0,0 +1,153 @@
+import time
+import logging
+from pathlib import Path
+from collections import Counter, defaultdict
+from contextlib import contextmanager
+from typing import Any, Dict, Generator, Iterable, List, Optional, TypeVar
+import orjson
+
+log = logging.getLogger(__name__)
+
+T = TypeVar("T")
+
+# Stages which run in the main process add up to the wall-clock time of the
+# import; the extraction stages are summed over all worker processes.
+MAIN_STAGES = ["parse", "check", "dedupe", "bucket", "wait", "save"]
+WORKER_STAGES = ["nlp", "extract", "extract_tag", "pick_name"]
+
+
+class Profile(object):
+    """Timers and counters for the stages of an import. Stages can be nested, and
+    each stage is only charged for the time not spent in the stages nested within
+    it. The profiles of the worker processes are merged into that of the main
+    process."""
+
+    def __init__(self) -> None:
+        self.started = time.perf_counter()
+        self.timers: Dict[str, float] = defaultdict(float)
+        self.counters: Counter[str] = Counter()
+        self.depths: List[int] = []
+        self.last_progress = self.started
+        self._stack: List[List[float]] = []
+
+    def charge(self, stage: str, start: float) -> None:
+        """Charge the time since `start` to a stage. This is cheaper than `timer`
+        in tight loops, but the stage must not contain any nested stages."""
+        elapsed = time.perf_counter() - start
+        self.timers[stage] += elapsed
+        if len(self._stack):
+            self._stack[-1][0] += elapsed
+
+    @contextmanager
+    def timer(self, stage: str) -> Generator[None, None, None]:
+        start = time.perf_counter()
+        nested = [0.0]
+        self._stack.append(nested)
+        try:
+            yield
+        finally:
+            self._stack.pop()
+            elapsed = time.perf_counter() - start
+            self.timers[stage] += elapsed - nested[0]
+            if len(self._stack):
+                self._stack[-1][0] += elapsed
+
+    def timed(self, stage: str, items: Iterable[T]) -> Generator[T, None, None]:
+        """Charge the time spent producing each item of an iterable to a stage."""
+        iterator = iter(items)
+        while True:
+            with self.timer(stage):
+                try:
+                    item = next(iterator)
+                except StopIteration:
+                    return
+            yield item
+
+    def counted(self, counter: str, items: Iterable[T]) -> Generator[T, None, None]:
+        for item in items:
+            self.counters[counter] += 1
+            yield item
+
+    def depth(self, depth: int) -> None:
+        """Record a sample of the number of batches waiting for extraction."""
+        self.depths.append(depth)
+
+    def merge(self, other: "Profile") -> None:
+        for stage, seconds in other.timers.items():
+            self.timers[stage] += seconds
+        self.counters.update(other.counters)
+
+    @property
+    def elapsed(self) -> float:
+        return time.perf_counter() - self.started
+
+    def rate(self, counter: str, seconds: Optional[float] = None) -> float:
+        seconds = self.elapsed if seconds is None else seconds
+        return self.counters[counter] / max(seconds, 1e-9)
+
+    def progress(self, interval: float) -> None:
+        """Log a progress line if more than `interval` seconds have passed since
+        the previous one."""
+        now = time.perf_counter()
+        if now - self.last_progress < interval:
+            return
+        self.last_progress = now
+        log.info(
+            "Progress: %d articles (%.1f/s), %d mentions (%.1f/s), %d batches in flight",
+            self.counters["articles"],
+            self.rate("articles"),
+            self.counters["mentions"],
+            self.rate("mentions"),
+            self.depths[-1] if len(self.depths) else 0,
+        )
+
+    def report(self) -> Dict[str, Any]:
+        elapsed = self.elapsed
+        depths = self.depths or [0]
+        return {
+            "elapsed": elapsed,
+            "counters": dict(self.counters),
+            "stages": {
+                "main": {s: self.timers.get(s, 0.0) for s in MAIN_STAGES},
+                "workers": {s: self.timers.get(s, 0.0) for s in WORKER_STAGES},
+            },
+            "rates": {
+                "articles": self.rate("articles"),
+                "mentions": self.rate("mentions"),
+                "rows": self.rate("rows"),
+                "rows_saving": self.rate("rows", self.timers.get("save", 0.0)),
+            },
+            "queue": {
+                "max": max(depths),
+                "mean": sum(depths) / len(depths),
+            },
+        }
+
+    def summary(self) -> None:
+        report = self.report()
+        elapsed = report["elapsed"]
+        log.info(
+            "Imported %d articles in %.1fs: %.1f articles/s, %.1f mentions/s, "
+            "%.1f rows/s (%.1f rows/s while saving)",
+            self.counters["articles"],
+            elapsed,
+            report["rates"]["articles"],
+            report["rates"]["mentions"],
+            report["rates"]["rows"],
+            report["rates"]["rows_saving"],
+        )
+        for stage, seconds in report["stages"]["main"].items():
+            share = (seconds / max(elapsed, 1e-9)) * 100
+            log.info("  %-12s %9.2fs %5.1f%%", stage, seconds, share)
+        log.info("Extraction time, summed over workers:")
+        for stage, seconds in report["stages"]["workers"].items():
+            log.info("  %-12s %9.2fs", stage, seconds)
+        log.info(
+            "Batches in flight: %d at most, %.1f on average",
+            report["queue"]["max"],
+            report["queue"]["mean"],
+        )
+
+    def write(self, path: Path) -> None:
+        with open(path, "wb") as fh:
+            fh.write(orjson.dumps(self.report(), option=orjson.OPT_INDENT_2))
@@ -0,0 +1,89 @@
+import io
+import bz2
+import gzip
+import mmap
+import logging
+import orjson
+from pathlib import Path
+from typing import BinaryIO, Container, Generator, Optional, Tuple
+from articledata import Article
+from pydantic import ValidationError
+
+from storyweb.parse.util import Shard, shard_of
+
+log = logging.getLogger(__name__)
+
+
+def _open_zstd(path: Path) -> BinaryIO:
+    try:
+        import zstandard
+    except ImportError:
+        raise RuntimeError("Reading %s requires the `zstandard` package." % path)
+    reader = zstandard.ZstdDecompressor().stream_reader(open(path, "rb"))
+    return io.BufferedReader(reader)  # type: ignore
+
+
+def _open_gzip(path: Path) -> BinaryIO:
+    return gzip.open(path, "rb")  # type: ignore
+
+
+def _open_bz2(path: Path) -> BinaryIO:
+    return bz2.open(path, "rb")  # type: ignore
+
+
+DECOMPRESSORS = {
+    ".gz": _open_gzip,
+    ".bz2": _open_bz2,
+    ".zst": _open_zstd,
+}
+
+
+def iter_lines(path: Path, offset: int = 0) -> Generator[Tuple[int, bytes], None, None]:
+    """Iterate over the lines of a (possibly compressed) text file, starting at the
+    given byte offset. Each line is returned with the offset of the line following
+    it. For compressed files, offsets refer to the decompressed stream."""
+    decompressor = DECOMPRESSORS.get(path.suffix.lower())
+    if decompressor is not None:
+        with decompressor(path) as fh:
+            position = 0
+            for line in fh:
+                position += len(line)
+                if position > offset:
+                    yield (position, line)
+        return
+
+    with open(path, "rb") as fh:
+        if path.stat().st_size == 0:
+            return
+        with mmap.mmap(fh.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+            mm.seek(offset)
+            while line := mm.readline():
+                yield (mm.tell(), line)
+
+
+def read_raw_articles(
+    path: Path,
+    offset: int = 0,
+    languages: Optional[Container[str]] = None,
+    shard: Optional[Shard] = None,
+) -> Generator[Tuple[int, Article], None, None]:
+    """Read articles from a JSONL file, starting at the given byte offset. Lines are
+    pre-filtered on their ID, language and shard before the (comparatively
+    expensive) validation of the article. Each article is returned with the offset
+    of the line following it."""
+    for (position, line) in iter_lines(path, offset=offset):
+        try:
+            data = orjson.loads(line)
+        except orjson.JSONDecodeError as exc:
+            log.warning("Invalid JSON at byte %d: %s", position, exc)
+            continue
+        if data.get("id") is None:
+            continue
+        if languages is not None and data.get("language") not in languages:
+            continue
+        if shard is not None and shard_of(data["id"], shard[1]) != shard[0]:
+            continue
+        try:
+            yield (position, Article.parse_obj(data))
+        except ValidationError as ve:
+            log.warning("Article validation [%s]: %s", data.get("id"), ve)
@@ -0,0 +1,88 @@
+import hashlib
+import logging
+import multiprocessing
+from collections import deque
+from concurrent.futures import Future, ProcessPoolExecutor
+from typing import Callable, Deque, Generator, Iterable, List, Optional, Tuple
+from typing import TypeVar
+
+log = logging.getLogger(__name__)
+
+T = TypeVar("T")
+R = TypeVar("R")
+
+
+Shard = Tuple[int, int]
+
+
+def parse_shard(text: str) -> Shard:
+    """Parse a shard specification like `2/4`, i.e. the second of four."""
+    index, _, count = text.partition("/")
+    shard = (int(index), int(count))
+    if shard[1] < 1 or not (1 <= shard[0] <= shard[1]):
+        raise ValueError("Invalid shard: %r" % text)
+    return shard
+
+
+def shard_of(key: str, count: int) -> int:
+    """Deterministically assign a key to one of `count` shards, numbered from 1."""
+    digest = hashlib.md5(key.encode("utf-8")).hexdigest()
+    return (int(digest[:8], 16) % count) + 1
+
+
+def chunked(items: Iterable[T], size: int) -> Generator[List[T], None, None]:
+    chunk: List[T] = []
+    for item in items:
+        chunk.append(item)
+        if len(chunk) >= size:
+            yield chunk
+            chunk = []
+    if len(chunk):
+        yield chunk
+
+
+def chunked_budget(
+    items: Iterable[T], size: int, budget: int, weight: Callable[[T], int]
+) -> Generator[List[T], None, None]:
+    """Group items into chunks of at most `size` items, closing each chunk early
+    once the summed weight of its items reaches `budget`."""
+    chunk: List[T] = []
+    total = 0
+    for item in items:
+        chunk.append(item)
+        total += weight(item)
+        if len(chunk) >= size or total >= budget:
+            yield chunk
+            chunk = []
+            total = 0
+    if len(chunk):
+        yield chunk
+
+
+def map_ordered(
+    func: Callable[[T], R],
+    items: Iterable[T],
+    workers: int = 1,
+    backlog: int = 2,
+    context: Optional[str] = None,
+) -> Generator[Tuple[T, R], None, None]:
+    """Apply `func` to all items, using a pool of worker processes if more than
+    one worker is requested. Pairs of item and result are yielded in input order,
+    and no more than `workers * backlog` items are in flight at any time. The
+    `context` names the multiprocessing start method for the pool."""
+    if workers <= 1:
+        for item in items:
+            yield (item, func(item))
+        return
+
+    mp_context = multiprocessing.get_context(context)
+    with ProcessPoolExecutor(max_workers=workers, mp_context=mp_context) as executor:
+        pending: Deque[Tuple[T, Future[R]]] = deque()
+        for item in items:
+            pending.append((item, executor.submit(func, item)))
+            if len(pending) >= workers * backlog:
+                item, future = pending.popleft()
+                yield (item, future.result())
+        while len(pending):
+            item, future = pending.popleft()
+            yield (item, future.result())
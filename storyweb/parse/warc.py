@@ -0,0 +1,63 @@
+import logging
+from pathlib import Path
+from typing import Any, Generator, Iterable, List, Tuple
+
+from storyweb.parse import MP_CONTEXT
+from storyweb.parse.crawl import MIN_TEXT
+from storyweb.parse.extract import extract_pages
+from storyweb.parse.pipeline import import_articles
+
+log = logging.getLogger(__name__)
+
+# Larger payloads are not web pages worth extracting, and would only bloat the
+# worker queues:
+MAX_PAYLOAD = 10 * 1024 * 1024
+
+
+def _archive_iterator(fh: Any) -> Any:
+    try:
+        from warcio.archiveiterator import ArchiveIterator
+    except ImportError:
+        raise RuntimeError("Reading WARC files requires the `warcio` package.")
+    return ArchiveIterator(fh)
+
+
+def read_warc_pages(path: Path) -> Generator[Tuple[str, bytes], None, None]:
+    """Stream the successful HTML responses from a (possibly gzipped) WARC file,
+    as pairs of URL and body."""
+    with open(path, "rb") as fh:
+        for record in _archive_iterator(fh):
+            if record.rec_type != "response" or record.http_headers is None:
+                continue
+            if record.http_headers.get_statuscode() != "200":
+                continue
+            content_type = record.http_headers.get_header("Content-Type") or ""
+            if "html" not in content_type.lower():
+                continue
+            length = record.rec_headers.get_header("Content-Length")
+            if length is not None and int(length) > MAX_PAYLOAD:
+                continue
+            url = record.rec_headers.get_header("WARC-Target-URI")
+            if url is None:
+                continue
+            yield (url, record.content_stream().read())
+
+
+def import_warcs(
+    paths: Iterable[Path],
+    workers: int = 1,
+    force: bool = False,
+) -> List[str]:
+    """Rebuild articles from WARC archives: the HTML extraction runs in a pool of
+    `workers` processes and feeds into the batched NER import. Both stages only
+    take on new documents as earlier ones are finished."""
+
+    def _pages() -> Generator[Tuple[str, bytes], None, None]:
+        for path in paths:
+            log.info("Reading WARC file: %s", path)
+            yield from read_warc_pages(path)
+
+    articles = extract_pages(
+        _pages(), workers=workers, min_text=MIN_TEXT, context=MP_CONTEXT
+    )
+    return import_articles(articles, workers=workers, force=force, context=MP_CONTEXT)
@@ -0,0 +1,198 @@
+import logging
+from datetime import datetime, timezone
+from urllib.parse import urlencode
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Dict, Generator, List, Optional, Tuple
+import orjson
+from lxml import html
+from lxml.etree import ParserError
+from articledata import URL, Article
+
+from storyweb.db import engine
+from storyweb.models import Source
+from storyweb.logic.imports import fetch_sync_cursor, save_sync_cursor
+from storyweb.parse.extract import detect_article_languages
+from storyweb.parse.fetch import HostLimiter, fetch_response, THREADS
+from storyweb.parse.pipeline import import_articles
+from storyweb.parse.util import chunked
+
+log = logging.getLogger(__name__)
+
+PER_PAGE = 100
+HOST_LIMIT = 4
+FIELDS = "id,link,date_gmt,modified_gmt,title,content,excerpt,_links,_embedded"
+BLOCKS = {"p", "h1", "h2", "h3", "h4", "h5", "h6", "li", "blockquote", "pre"}
+
+
+def html_text(fragment: Optional[str]) -> str:
+    """Convert a rendered HTML fragment to text, with blank lines between
+    paragraphs."""
+    if fragment is None or not len(fragment.strip()):
+        return ""
+    try:
+        doc = html.fromstring(fragment)
+    except (ParserError, ValueError):
+        return ""
+    blocks: List[str] = []
+    for el in doc.iter(*BLOCKS):
+        if any(a.tag in BLOCKS for a in el.iterancestors()):
+            continue
+        text = " ".join(el.text_content().split())
+        if len(text):
+            blocks.append(text)
+    if not len(blocks):
+        return " ".join(doc.text_content().split())
+    return "\n\n".join(blocks)
+
+
+def _rendered(post: Dict[str, Any], field: str) -> Optional[str]:
+    value = post.get(field)
+    if isinstance(value, dict):
+        return value.get("rendered")
+    return None
+
+
+def post_article(post: Dict[str, Any]) -> Optional[Article]:
+    """Convert a post from the WordPress REST API to an article, without
+    having to run the HTML extraction on the page."""
+    link = post.get("link")
+    text = html_text(_rendered(post, "content"))
+    if link is None or not len(text):
+        return None
+    url = URL(link)
+    bylines: List[str] = []
+    for author in post.get("_embedded", {}).get("author", []):
+        name = author.get("name") if isinstance(author, dict) else None
+        if name is not None:
+            bylines.append(name)
+    lede = html_text(_rendered(post, "excerpt"))
+    return Article(
+        id=url.id,
+        url=url.url,
+        title=html_text(_rendered(post, "title")) or url.url,
+        site=url.domain,
+        date=post.get("date_gmt"),
+        bylines=bylines,
+        lede=lede or None,
+        language="xxx",
+        locale="xx",
+        text=text,
+        extracted_at=datetime.utcnow().isoformat(),
+    )
+
+
+def _posts_url(api: str, page: int, modified_after: Optional[datetime]) -> str:
+    params = {
+        "per_page": PER_PAGE,
+        "page": page,
+        "orderby": "modified",
+        "order": "asc",
+        "_embed": "author",
+        "_fields": FIELDS,
+    }
+    if modified_after is not None:
+        since = modified_after.replace(tzinfo=timezone.utc)
+        params["modified_after"] = since.isoformat()
+    return f"{api.rstrip('/')}/wp/v2/posts?{urlencode(params)}"
+
+
+class PostsSync(object):
+    """Page through the posts of a WordPress site, oldest modification first. The
+    first page tells how many pages there are, the others are then requested
+    concurrently. The sync keeps track of the newest modification time it has
+    seen, and of any pages which could not be fetched."""
+
+    def __init__(
+        self,
+        api: str,
+        modified_after: Optional[datetime] = None,
+        threads: int = THREADS,
+    ):
+        self.api = api
+        self.modified_after = modified_after
+        self.threads = threads
+        self.newest = modified_after
+        self.failed = 0
+        self.limiter = HostLimiter(limit=HOST_LIMIT)
+
+    def _posts(self, res: Any) -> List[Dict[str, Any]]:
+        if res is None:
+            self.failed += 1
+            return []
+        posts: List[Dict[str, Any]] = orjson.loads(res.content)
+        for post in posts:
+            modified = _modified(post)
+            if modified is not None and (self.newest is None or modified > self.newest):
+                self.newest = modified
+        return posts
+
+    def posts(self) -> Generator[Dict[str, Any], None, None]:
+        url = _posts_url(self.api, 1, self.modified_after)
+        res = fetch_response(url, limiter=self.limiter)
+        yield from self._posts(res)
+        if res is None:
+            return
+        total = int(res.headers.get("X-WP-TotalPages", 1))
+        log.info("WordPress API [%s]: %d pages of posts", self.api, total)
+        pages = range(2, total + 1)
+        urls = [_posts_url(self.api, p, self.modified_after) for p in pages]
+        with ThreadPoolExecutor(max_workers=self.threads) as executor:
+            for chunk in chunked(urls, self.threads * 2):
+                futures = [
+                    executor.submit(fetch_response, u, None, self.limiter)
+                    for u in chunk
+                ]
+                for future in futures:
+                    yield from self._posts(future.result())
+
+    def articles(self) -> Generator[Article, None, None]:
+        """Generate the articles of the site, detecting their language in
+        batches."""
+        for batch in chunked(self.posts(), PER_PAGE):
+            articles = [a for a in map(post_article, batch) if a is not None]
+            detect_article_languages(articles)
+            yield from articles
+
+
+def _modified(post: Dict[str, Any]) -> Optional[datetime]:
+    """The modification time of a post, in UTC."""
+    modified = post.get("modified_gmt")
+    if modified is None:
+        return None
+    return datetime.fromisoformat(modified).replace(tzinfo=None)
+
+
+def _cursor_key(api: str) -> str:
+    return f"wp:{api.rstrip('/')}"
+
+
+def import_wordpress(
+    sources: List[Source],
+    workers: int = 1,
+    threads: int = THREADS,
+    since: Optional[datetime] = None,
+    full: bool = False,
+) -> List[Tuple[Source, int]]:
+    """Import the posts of all sources which have a WordPress API. Unless a
+    start date or a full sync is requested, only posts modified since the last
+    complete sync of each site are fetched."""
+    results: List[Tuple[Source, int]] = []
+    for source in sources:
+        if source.wp_api is None:
+            continue
+        key = _cursor_key(source.wp_api)
+        modified_after: Optional[datetime] = since
+        if since is None and not full:
+            with engine.begin() as conn:
+                modified_after = fetch_sync_cursor(conn, key)
+        sync = PostsSync(source.wp_api, modified_after=modified_after, threads=threads)
+        # The page requests run in threads while the NER workers start:
+        ids = import_articles(sync.articles(), workers=workers, context="spawn")
+        log.info("WordPress [%s]: %d articles", source.name, len(ids))
+        if sync.failed > 0:
+            log.warning("WordPress [%s]: %d pages failed", source.name, sync.failed)
+        elif sync.newest is not None:
+            with engine.begin() as conn:
+                save_sync_cursor(conn, key, sync.newest)
+        results.append((source, len(ids)))
+    return results
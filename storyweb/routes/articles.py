@@ -4,12 +4,15 @@ from fastapi.exceptions import HTTPException
 
 from storyweb.db import Conn
 from storyweb.logic.articles import fetch_article, list_articles, list_sites
+from storyweb.logic.articles import fetch_sentences, list_mentions
 from storyweb.routes.util import get_conn, get_listing
 from storyweb.models import (
     Article,
     ArticleDetails,
+    ArticleMention,
     Listing,
     ListingResponse,
+    Sentence,
     Site,
 )
 
@@ -54,3 +57,26 @@ def article_view(
     if article is None:
         raise HTTPException(404)
     return article
+
+
+@router.get("/articles/{article_id}/mentions", response_model=List[ArticleMention])
+def article_mentions(
+    conn: Conn = Depends(get_conn),
+    article_id: str = Path(),
+):
+    """List the character spans of all entity mentions in the article text, e.g.
+    for highlighting, along with their current clusters."""
+    return list_mentions(conn, article_id)
+
+
+@router.get("/articles/{article_id}/sentences", response_model=List[Sentence])
+def article_sentences(
+    conn: Conn = Depends(get_conn),
+    article_id: str = Path(),
+):
+    """List the sentences of the article in which entities were tagged, with
+    their text and character offsets."""
+    article = fetch_article(conn, article_id)
+    if article is None:
+        raise HTTPException(404)
+    return fetch_sentences(conn, article)
@@ -6,7 +6,6 @@ from storyweb.logic.clusters import (
     fetch_cluster,
     merge_cluster,
     explode_cluster,
-    untag_article,
 )
 from storyweb.logic.links import (
     create_link,
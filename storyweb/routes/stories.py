@@ -16,12 +16,13 @@ from storyweb.logic.stories import (
 from storyweb.logic.clusters import list_story_pairs
 from storyweb.logic.graph import generate_graph_gexf, generate_graph_ftm
 from storyweb.logic.links import story_merge
-from storyweb.parse import import_article_by_url
+from storyweb.parse import import_article_by_url, import_articles_by_url
 from storyweb.routes.util import get_conn, get_listing
 from storyweb.models import (
     StoryMutation,
     StoryArticleToggle,
     StoryArticleImportUrl,
+    StoryArticleImportUrls,
     Story,
     ClusterPair,
     Listing,
@@ -87,6 +88,24 @@ def story_article_import_url(
     return story
 
 
+@router.post("/stories/{story_id}/articles/import-urls", response_model=Story)
+def story_article_import_urls(
+    data: StoryArticleImportUrls,
+    conn: Conn = Depends(get_conn),
+    story_id: int = Path(),
+):
+    """Import a short list of articles by URL and add them to the story. Pages
+    which cannot be fetched or parsed are skipped. Longer lists are rejected, they
+    should be imported with `storyweb import-urls`."""
+    story = fetch_story(conn, story_id)
+    if story is None:
+        raise HTTPException(404)
+    for article_id in import_articles_by_url(data.urls, dedupe=False):
+        story_merge(conn, story_id, article_id)
+        toggle_story_article(conn, story_id, article_id, delete_existing=False)
+    return story
+
+
 @router.get("/stories/{story_id}/pairs", response_model=ListingResponse[ClusterPair])
 def story_pairs(
     conn: Conn = Depends(get_conn),
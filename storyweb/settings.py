@@ -3,3 +3,9 @@ import os
 DB_URL = os.environ.get("STORYWEB_DB_URL")
 if DB_URL is None:
     raise RuntimeError("No $STORYWEB_DB_URL is configured!")
+
+# Path of an SQLite file used to cache NER annotations across imports:
+NLP_CACHE = os.environ.get("STORYWEB_NLP_CACHE")
+
+# Directory in which raw web pages are cached when importing articles by URL:
+HTTP_CACHE = os.environ.get("STORYWEB_HTTP_CACHE")
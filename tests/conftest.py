@@ -0,0 +1,21 @@
+import os
+import pytest
+from sqlalchemy import text
+
+# The tests which need a database empty all of its tables, so they only run
+# against a database which is configured for them explicitly:
+TEST_DB_URL = os.environ.get("STORYWEB_TEST_DB_URL")
+os.environ["STORYWEB_DB_URL"] = TEST_DB_URL or "postgresql://localhost/storyweb_test"
+
+
+@pytest.fixture
+def db():
+    if TEST_DB_URL is None:
+        pytest.skip("No $STORYWEB_TEST_DB_URL is configured")
+    from storyweb.db import create_db, engine, meta
+
+    create_db()
+    with engine.begin() as conn:
+        names = ", ".join(t.name for t in meta.sorted_tables)
+        conn.execute(text(f"TRUNCATE {names}"))
+    return engine
@@ -0,0 +1,146 @@
+import random
+from typing import List
+from sqlalchemy import select
+
+from storyweb.db import minhash_table, minhash_band_table
+from storyweb.logic.articles import save_extracted_batch
+from storyweb.models import ArticleDetails, ExtractedArticle
+from storyweb.parse.dedupe import BANDS, NUM_PERM, ROWS, THRESHOLD
+from storyweb.parse.dedupe import DuplicateIndex, bands, minhash, similarity
+from storyweb.parse.pipeline import article_hash, skip_unchanged
+
+WORDS = [f"word{i}" for i in range(2000)]
+
+
+def make_text(seed: int, length: int = 400) -> str:
+    rng = random.Random(seed)
+    return " ".join(rng.choice(WORDS) for _ in range(length))
+
+
+def edit_text(text: str, every: int = 100) -> str:
+    words = text.split(" ")
+    for i in range(0, len(words), every):
+        words[i] = "changed"
+    return " ".join(words)
+
+
+def make_article(id: str, text: str) -> ArticleDetails:
+    return ArticleDetails(id=id, site="test", url=f"http://test/{id}", text=text)
+
+
+def test_minhash():
+    text = make_text(1)
+    signature = minhash(text)
+    assert signature is not None
+    assert signature.shape == (NUM_PERM,)
+    assert (signature == minhash(text)).all()
+    assert (signature == minhash(text.upper())).all()
+    assert minhash("far too short to compare") is None
+
+
+def test_bands():
+    signature = minhash(make_text(1))
+    keys = bands(signature)
+    assert len(keys) == BANDS
+    assert [band for (band, _) in keys] == list(range(BANDS))
+    assert keys == bands(signature.copy())
+
+    changed = signature.copy()
+    changed[ROWS * 3] += 1
+    changed_keys = bands(changed)
+    differ = [b for (b, (k, c)) in enumerate(zip(keys, changed_keys)) if k != c]
+    assert differ == [3]
+
+
+def test_similarity():
+    text = make_text(1)
+    signature = minhash(text)
+    assert similarity(signature, signature) == 1.0
+    assert similarity(signature, minhash(edit_text(text))) >= THRESHOLD
+    assert similarity(signature, minhash(make_text(2))) < 0.2
+
+
+def _detect(index: DuplicateIndex, articles: List[ArticleDetails]) -> None:
+    list(index.detect((0, a) for a in articles))
+
+
+def test_detect_in_chunk(db):
+    original = make_text(1)
+    articles = [
+        make_article("a", original),
+        make_article("b", make_text(2)),
+        make_article("c", edit_text(original)),
+        make_article("d", "too short"),
+    ]
+    index = DuplicateIndex()
+    _detect(index, articles)
+    assert [a.duplicate_of for a in articles] == [None, None, "a", None]
+
+    # Nothing is written to the index before the articles are saved:
+    with db.connect() as conn:
+        assert conn.execute(select(minhash_table)).fetchall() == []
+
+    with db.begin() as conn:
+        index.save(conn, [a.id for a in articles])
+    assert not len(index.pending)
+    assert not len(index.buckets)
+    with db.connect() as conn:
+        stored = conn.execute(select(minhash_table.c.article)).scalars().all()
+        assert sorted(stored) == ["a", "b"]
+        bands_stmt = select(minhash_band_table.c.article)
+        assert len(conn.execute(bands_stmt).fetchall()) == BANDS * 2
+
+
+def test_detect_across_chunks(db):
+    original = make_text(1)
+    index = DuplicateIndex()
+    first = make_article("a", original)
+    _detect(index, [first])
+
+    # The original is not saved yet, but is matched from memory:
+    second = make_article("b", edit_text(original))
+    _detect(index, [second])
+    assert second.duplicate_of == "a"
+
+    with db.begin() as conn:
+        index.save(conn, ["a", "b"])
+
+    # Once saved, a new index finds it in the database:
+    third = make_article("c", edit_text(original, every=90))
+    _detect(DuplicateIndex(), [third])
+    assert third.duplicate_of == "a"
+
+
+def test_unsaved_entries_are_not_written(db):
+    index = DuplicateIndex()
+    _detect(index, [make_article("a", make_text(1))])
+    with db.begin() as conn:
+        index.save(conn, ["b"])
+    with db.connect() as conn:
+        assert conn.execute(select(minhash_table)).fetchall() == []
+    assert "a" in index.pending
+
+
+def test_skip_unchanged_duplicates(db):
+    original = make_article("a", make_text(1))
+    duplicate = make_article("b", edit_text(original.text))
+    duplicate.duplicate_of = "a"
+    articles = [original, duplicate]
+    for article in articles:
+        article.hash = article_hash(article)
+    batch = [
+        ExtractedArticle(
+            article=a, sentences=[], tag_sentences=[], tags=[], mentions=[]
+        )
+        for a in articles
+    ]
+    with db.begin() as conn:
+        save_extracted_batch(conn, batch)
+
+    def _kept(dedupe: bool) -> List[str]:
+        unchanged = [(0, a.copy(update=dict(duplicate_of=None))) for a in articles]
+        return [a.id for (_, a) in skip_unchanged(unchanged, dedupe=dedupe)]
+
+    assert _kept(dedupe=True) == []
+    # Without near-duplicate detection, the duplicate is extracted after all:
+    assert _kept(dedupe=False) == ["b"]
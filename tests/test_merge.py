@@ -0,0 +1,208 @@
+from datetime import datetime
+from typing import Dict, List, Set, FrozenSet
+from sqlalchemy import select
+
+from storyweb.db import tag_table, tag_cluster_table, cluster_table
+from storyweb.db import cluster_type_table, link_table
+from storyweb.logic.articles import save_extracted_batch
+from storyweb.logic.links import auto_merge, save_links
+from storyweb.logic.merge import UnionFind, auto_merge_bulk
+from storyweb.models import ArticleDetails, ExtractedArticle, Link, Tag
+from storyweb.ontology import LinkType
+
+
+def make_sets(size: int) -> UnionFind:
+    sets = UnionFind()
+    for _ in range(size):
+        sets.add()
+    return sets
+
+
+def test_union_by_size():
+    sets = make_sets(4)
+    assert sets.union(0, 1)
+    assert sets.union(2, 1)
+    root = sets.find(0)
+    assert sets.find(1) == sets.find(2) == root
+    assert sets.size[root] == 3
+    # The smaller set is attached to the larger one:
+    assert sets.union(3, 0)
+    assert sets.find(3) == root
+    assert sets.size[root] == 4
+    assert not sets.union(0, 3)
+
+
+def test_keep_apart():
+    sets = make_sets(3)
+    assert sets.keep_apart(0, 1)
+    assert not sets.union(0, 1)
+    assert sets.find(0) != sets.find(1)
+    assert sets.union(0, 2)
+    assert not sets.union(2, 1)
+    # Unchecked unions ignore the constraint, after which it cannot be recorded:
+    assert sets.union(1, 2, check=False)
+    assert not sets.keep_apart(0, 1)
+
+
+def test_keep_apart_transitive():
+    sets = make_sets(6)
+    sets.keep_apart(0, 3)
+    assert sets.union(0, 1)
+    assert sets.union(3, 4)
+    # Neither 1 nor 4 is kept apart from the other, but their sets are:
+    assert sets._conflict(sets.find(1), sets.find(4))
+    assert sets._conflict(sets.find(4), sets.find(1))
+    assert not sets.union(1, 4)
+    assert not sets.union(4, 1)
+
+    # The constraints of both sides are kept when sets are merged:
+    sets.keep_apart(2, 5)
+    assert sets.union(2, 1)
+    assert sets.union(5, 4)
+    assert not sets.union(2, 5)
+    assert not sets.union(0, 5)
+    assert sets.find(0) == sets.find(1) == sets.find(2)
+    assert sets.find(3) == sets.find(4) == sets.find(5)
+
+
+def _tag(id: str, article: str, fingerprint: str) -> Tag:
+    return Tag(
+        id=id,
+        type="PER",
+        label=fingerprint.title(),
+        article=article,
+        fingerprint=fingerprint,
+        count=1,
+        frequency=1.0,
+    )
+
+
+def _load(db, tags: List[Tag], links: List[Link] = []) -> None:
+    by_article: Dict[str, List[Tag]] = {}
+    for tag in tags:
+        by_article.setdefault(tag.article, []).append(tag)
+    batch = [
+        ExtractedArticle(
+            article=ArticleDetails(id=a, site="test", url=a, text=""),
+            sentences=[],
+            tag_sentences=[],
+            tags=article_tags,
+            mentions=[],
+        )
+        for a, article_tags in by_article.items()
+    ]
+    with db.begin() as conn:
+        save_extracted_batch(conn, batch)
+        if len(links):
+            save_links(conn, links)
+
+
+def _link(source: str, target: str, type: str) -> Link:
+    return Link(
+        source=source,
+        source_cluster=source,
+        target=target,
+        target_cluster=target,
+        type=type,
+        user="test",
+        timestamp=datetime.utcnow(),
+    )
+
+
+def _partition(db) -> Set[FrozenSet[str]]:
+    clusters: Dict[str, Set[str]] = {}
+    with db.connect() as conn:
+        stmt = select(tag_cluster_table.c.tag, tag_cluster_table.c.cluster)
+        for tag, cluster in conn.execute(stmt):
+            clusters.setdefault(cluster, set()).add(tag)
+    return set(frozenset(c) for c in clusters.values())
+
+
+def _corpus() -> List[Tag]:
+    fingerprints = ["anna-smith", "bob-jones", "carla-diaz", "dan-wu"]
+    tags: List[Tag] = []
+    for i in range(40):
+        article = f"article-{i % 12}"
+        fingerprint = fingerprints[(i * 7) % len(fingerprints)]
+        tags.append(_tag(f"tag-{i:02d}", article, fingerprint))
+    return tags
+
+
+def test_check_links(db):
+    tags = [_tag("a", "1", "anna-smith"), _tag("b", "2", "anna-smith")]
+    _load(db, tags, [_link("a", "b", LinkType.OBSERVER)])
+    with db.begin() as conn:
+        assert auto_merge_bulk(conn) == 0
+    assert _partition(db) == {frozenset(["a"]), frozenset(["b"])}
+    with db.begin() as conn:
+        assert auto_merge_bulk(conn, check_links=False) == 1
+    assert _partition(db) == {frozenset(["a", "b"])}
+
+
+def test_check_links_transitive(db):
+    # b may join a or c, but not both, as a and c are linked:
+    tags = [
+        _tag("a", "1", "anna-smith"),
+        _tag("b", "2", "anna-smith"),
+        _tag("c", "3", "anna-smith"),
+    ]
+    _load(db, tags, [_link("a", "c", LinkType.OBSERVER)])
+    with db.begin() as conn:
+        auto_merge_bulk(conn)
+    partition = _partition(db)
+    assert len(partition) == 2
+    assert not any({"a", "c"}.issubset(c) for c in partition)
+
+
+def test_bulk_matches_auto_merge(db):
+    links = [_link("tag-00", "tag-01", LinkType.SAME)]
+    _load(db, _corpus(), links)
+    with db.connect() as conn:
+        auto_merge(conn)
+    expected = _partition(db)
+    # Four fingerprints, two of which are joined by the SAME link:
+    assert len(expected) == 3
+
+    with db.begin() as conn:
+        for table in (
+            link_table,
+            tag_cluster_table,
+            cluster_table,
+            cluster_type_table,
+            tag_table,
+        ):
+            conn.execute(table.delete())
+    _load(db, _corpus(), links)
+    with db.begin() as conn:
+        assert auto_merge_bulk(conn) > 0
+    assert _partition(db) == expected
+
+
+def _cluster_types(db) -> Dict[str, int]:
+    with db.connect() as conn:
+        stmt = select(cluster_type_table.c.type, cluster_type_table.c.clusters)
+        return {t: c for t, c in conn.execute(stmt) if c != 0}
+
+
+def test_reimport_refreshes_clusters(db):
+    tags = [_tag("a", "1", "anna-smith"), _tag("b", "2", "anna-smith")]
+    _load(db, tags)
+    with db.begin() as conn:
+        assert auto_merge_bulk(conn) == 1
+    assert _cluster_types(db) == {"PER": 1}
+
+    # Both tags change their type and label when their articles are extracted
+    # again, and one of them is mentioned more often:
+    tags = [
+        _tag("a", "1", "anna-smith").copy(update=dict(type="ORG", count=3)),
+        _tag("b", "2", "anna-smith").copy(update=dict(type="ORG", label="Anna")),
+    ]
+    _load(db, tags)
+    with db.connect() as conn:
+        stmt = select(cluster_table)
+        clusters = conn.execute(stmt).fetchall()
+    assert len(clusters) == 1
+    assert clusters[0].type == "ORG"
+    assert clusters[0].mentions == 4
+    assert sorted(clusters[0].labels) == ["Anna", "Anna-Smith"]
+    assert _cluster_types(db) == {"ORG": 1}